@@ -5,6 +5,7 @@ Common helpers and functionality used by all apps.
 import typing as T
 
 import copy
+import logging
 
 from appdaemon.plugins.hass import hassapi
 from appdaemon.utils import __version__ as AD_VERSION
@@ -19,6 +20,24 @@ LOG_PREFIX_INCOMING = "-->"
 LOG_PREFIX_OUTGOING = "<--"
 
 
+class LogMessage:
+    """A log message that is only formatted when converted to str.
+    msg may be a str or a callable returning one. If args are given,
+    str.format() is called on the message with them."""
+
+    __slots__ = ("msg", "args")
+
+    def __init__(self, msg: T.Any, args: T.Sequence[T.Any] = ()) -> None:
+        self.msg = msg
+        self.args = args
+
+    def __str__(self) -> str:
+        msg = self.msg() if callable(self.msg) else self.msg
+        if self.args:
+            return str(msg).format(*self.args)
+        return str(msg)
+
+
 class App(hassapi.Hass):
     """
     This is a sub-class of hassapi.Hass which adds some common
@@ -35,17 +54,53 @@ class App(hassapi.Hass):
         version = "0.0.0"
         config_schema = None  # type: T.Optional[T.Callable]
 
+    def _get_log_level(self, level: str) -> str:
+        """Returns the level to log messages of the given level with,
+        which is INFO instead of DEBUG if debug config option is
+        enabled."""
+
+        level = level.upper()
+        if level == "DEBUG" and self.args and self.args.get("debug"):
+            level = "INFO"
+        return level
+
+    def _get_ad_logger(self) -> T.Optional[logging.Logger]:
+        """Returns the logger AppDaemon writes the app's messages to or
+        None, if it can't be found. It's called logger since AppDaemon
+        4 and _logger before."""
+
+        for attr in ("logger", "_logger"):
+            logger = getattr(self, attr, None)
+            if isinstance(logger, logging.Logger):
+                return logger
+        return None
+
+    def is_log_level_enabled(self, level: str) -> bool:
+        """Tells whether messages of the given level would be logged,
+        according to the effective level of AppDaemon's logger. If that
+        can't be found, all levels are assumed to be enabled."""
+
+        logger = self._get_ad_logger()
+        if logger is None:
+            return True
+        level_no = logging.getLevelName(self._get_log_level(level))
+        return not isinstance(level_no, int) or logger.isEnabledFor(level_no)
+
     def log(  # pylint: disable=arguments-differ
-            self, msg: str, level: str = "INFO",
+            self, msg: T.Any, *args: T.Any, level: str = "INFO",
             prefix: T.Optional[str] = None
     ) -> None:
         """Wrapper around super().log() which changes the log level
         from DEBUG to INFO if debug config option is enabled.
-        It also adds an appropriate prefix to the log message."""
+        It also adds an appropriate prefix to the log message.
+        msg may be a callable returning the message or a format string
+        for args, which is only formatted when the level is enabled."""
 
-        level = level.upper()
-        if level == "DEBUG" and self.args and self.args.get("debug"):
-            level = "INFO"
+        if not self.is_log_level_enabled(level):
+            return
+
+        level = self._get_log_level(level)
+        msg = str(LogMessage(msg, args))
 
         if prefix is None:
             if level in ("DEBUG", "INFO"):
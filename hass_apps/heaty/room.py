@@ -371,10 +371,10 @@ class Room:
         else:
             self.log("No schedule configured.", level="DEBUG")
 
-    def log(self, msg: str, *args: T.Any, **kwargs: T.Any) -> None:
+    def log(self, msg: T.Any, *args: T.Any, **kwargs: T.Any) -> None:
         """Prefixes the room to log messages."""
-        msg = "[{}] {}".format(self, msg)
-        self.app.log(msg, *args, **kwargs)
+
+        self.app.log("[{}] {}", self, common.LogMessage(msg, args), **kwargs)
 
     def notify_set_temp_event(
             self, temp_expr: expr.ExprType, force_resend: bool = False,
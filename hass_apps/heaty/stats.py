@@ -145,10 +145,10 @@ class StatisticsZone:
 
         self.update_stats()
 
-    def log(self, msg: str, *args: T.Any, **kwargs: T.Any) -> None:
+    def log(self, msg: T.Any, *args: T.Any, **kwargs: T.Any) -> None:
         """Prefixes the zone to log messages."""
-        msg = "[{}] {}".format(self, msg)
-        self.app.log(msg, *args, **kwargs)
+
+        self.app.log("[{}] {}", self, common.LogMessage(msg, args), **kwargs)
 
     def update_stats(self) -> None:
         """Registers a timer for sending statistics to HA in 3 seconds."""
@@ -214,10 +214,10 @@ class Thermostat:
                  level="DEBUG")
         self.app.listen_state(self._state_cb, self.entity_id, attribute="all")
 
-    def log(self, msg: str, *args: T.Any, **kwargs: T.Any) -> None:
+    def log(self, msg: T.Any, *args: T.Any, **kwargs: T.Any) -> None:
         """Prefixes the thermostat to log messages."""
-        msg = "[{}] {}".format(self, msg)
-        self.room.log(msg, *args, **kwargs)
+
+        self.room.log("[{}] {}", self, common.LogMessage(msg, args), **kwargs)
 
     def cancel_resend_timer(self) -> None:
         """Cancels the resend timer for this thermostat, if one exists."""
@@ -70,7 +70,7 @@ class WindowSensor:
             states.append(open_state)
         return self.app.get_state(self.entity_id) in states
 
-    def log(self, msg: str, *args: T.Any, **kwargs: T.Any) -> None:
+    def log(self, msg: T.Any, *args: T.Any, **kwargs: T.Any) -> None:
         """Prefixes the window sensor to log messages."""
-        msg = "[{}] {}".format(self, msg)
-        self.room.log(msg, *args, **kwargs)
+
+        self.room.log("[{}] {}", self, common.LogMessage(msg, args), **kwargs)
@@ -57,8 +57,8 @@ class ActorBase:
         self._resending_timer = None
 
         left_tries = kwargs["left_tries"]
-        self.log("Setting value {} (left tries = {})."
-                 .format(self._wanted_value, left_tries),
+        self.log("Setting value {} (left tries = {}).",
+                 self._wanted_value, left_tries,
                  level="DEBUG", prefix=common.LOG_PREFIX_OUTGOING)
         self.do_send()
 
@@ -93,8 +93,7 @@ class ActorBase:
 
         if not self.values_equal(new_value, previous_value):
             self._current_value = new_value
-            self.log("Received value of {}."
-                     .format(repr(new_value)),
+            self.log("Received value of {!r}.", new_value,
                      level="DEBUG", prefix=common.LOG_PREFIX_INCOMING)
             self.events.trigger("value_changed", self, new_value)
 
@@ -159,10 +158,10 @@ class ActorBase:
         return self._resending_timer is None and \
                self.values_equal(self._current_value, self._wanted_value)
 
-    def log(self, msg: str, *args: T.Any, **kwargs: T.Any) -> None:
+    def log(self, msg: T.Any, *args: T.Any, **kwargs: T.Any) -> None:
         """Prefixes the actor to log messages."""
-        msg = "[{}] {}".format(self, msg)
-        self.room.log(msg, *args, **kwargs)
+
+        self.room.log("[{}] {}", self, common.LogMessage(msg, args), **kwargs)
 
     def notify_state_changed(self, attrs: dict) -> T.Any:  # pylint: disable=no-self-use,unused-argument
         """Is called when the entity's state has changed with the new
@@ -176,8 +175,8 @@ class ActorBase:
         timers.
         Returns whether initialization was successful."""
 
-        self.log("Initializing actor (entity_id={}, type={})."
-                 .format(repr(self.entity_id), repr(self.name)),
+        self.log("Initializing actor (entity_id={!r}, type={!r}).",
+                 self.entity_id, self.name,
                  level="DEBUG")
 
         self.log("Fetching initial state.",
@@ -234,8 +233,7 @@ class ActorBase:
 
         self._wanted_value = value
         if not force_resend and self.is_synced:
-            self.log("Not sending value {} redundantly."
-                     .format(repr(value)),
+            self.log("Not sending value {!r} redundantly.", value,
                      level="DEBUG")
             return False, value
 
@@ -5,6 +5,8 @@ This module implements the custom actor.
 import types
 import typing as T
 
+import time
+
 import voluptuous as vol
 
 from ... import common
@@ -50,14 +52,23 @@ class CustomActor(ActorBase):
         env.setdefault("app", self.app)
         env.setdefault("actor", self)
 
+        profiler = self.app.expression_profiler
+        if profiler is not None:
+            start = time.perf_counter()
+
+        result = None
+        failed = False
         try:
-            exec(expr, env)  # pylint: disable=exec-used
+            result = util.exec_expression(expr, env)
         except Exception as err:  # pylint: disable=broad-except
             self.log("Error while evaluating expression: {}"
                      .format(repr(err)),
                      level="ERROR")
-            return None
-        return env.get("result")
+            failed = True
+
+        if profiler is not None:
+            profiler.record(expr, time.perf_counter() - start, failed, self)
+        return result
 
     def do_send(self) -> None:
         """Executes the configured send script for self._wanted_value."""
@@ -87,8 +98,7 @@ class CustomActor(ActorBase):
 
         env = {"state": attrs}
         value = self._exec_script(self.cfg["state_hook"], env)
-        self.log("State {} resulted in a value of {}."
-                 .format(repr(attrs), repr(value)),
+        self.log("State {!r} resulted in a value of {!r}.", attrs, value,
                  level="DEBUG")
         if value is None:
             self.log("Ignoring value of None.", level="DEBUG")
@@ -66,8 +66,8 @@ class GenericActor(ActorBase):
         if cfg["value_param"] is not None:
             service_data.setdefault(cfg["value_param"], self._wanted_value)
 
-        self.log("Calling service {}, data = {}."
-                 .format(repr(service), repr(service_data)),
+        self.log("Calling service {!r}, data = {!r}.",
+                 service, service_data,
                  level="DEBUG", prefix=common.LOG_PREFIX_OUTGOING)
         self.app.call_service(service, **service_data)
 
@@ -91,8 +91,7 @@ class GenericActor(ActorBase):
         if state_attr is None:
             return None
         state = attrs.get(state_attr)
-        self.log("Attribute {} is {}."
-                 .format(repr(state_attr), repr(state)),
+        self.log("Attribute {!r} is {!r}.", state_attr, state,
                  level="DEBUG", prefix=common.LOG_PREFIX_INCOMING)
         if state is None:
             self.log("Ignoring state of None.", level="DEBUG")
@@ -275,9 +275,9 @@ class ThermostatActor(ActorBase):
         if not self.cfg["supports_opmodes"]:
             opmode = None
 
-        self.log("Setting temperature = {}, operation mode = {}."
-                 .format("<unset>" if temp is None else temp,
-                         "<unset>" if opmode is None else repr(opmode)),
+        self.log("Setting temperature = {}, operation mode = {}.",
+                 "<unset>" if temp is None else temp,
+                 "<unset>" if opmode is None else repr(opmode),
                  level="DEBUG", prefix=common.LOG_PREFIX_OUTGOING)
 
         if opmode is not None:
@@ -334,8 +334,8 @@ class ThermostatActor(ActorBase):
         _target_temp = None  # type: T.Optional[TempValueType]
         if self.cfg["supports_opmodes"]:
             opmode = attrs.get(self.cfg["opmode_state_attr"])
-            self.log("Attribute {} is {}."
-                     .format(repr(self.cfg["opmode_state_attr"]), repr(opmode)),
+            self.log("Attribute {!r} is {!r}.",
+                     self.cfg["opmode_state_attr"], opmode,
                      level="DEBUG", prefix=common.LOG_PREFIX_INCOMING)
             if opmode == self.cfg["opmode_off"]:
                 _target_temp = OFF
@@ -348,9 +348,8 @@ class ThermostatActor(ActorBase):
 
         if _target_temp is None:
             _target_temp = attrs.get(self.cfg["target_temp_state_attr"])
-            self.log("Attribute {} is {}."
-                     .format(repr(self.cfg["target_temp_state_attr"]),
-                             repr(_target_temp)),
+            self.log("Attribute {!r} is {!r}.",
+                     self.cfg["target_temp_state_attr"], _target_temp,
                      level="DEBUG", prefix=common.LOG_PREFIX_INCOMING)
 
         try:
@@ -363,8 +362,8 @@ class ThermostatActor(ActorBase):
         current_temp_attr = self.cfg["current_temp_state_attr"]
         if current_temp_attr:
             _current_temp = attrs.get(current_temp_attr)
-            self.log("Attribute {} is {}."
-                     .format(repr(current_temp_attr), repr(_current_temp)),
+            self.log("Attribute {!r} is {!r}.",
+                     current_temp_attr, _current_temp,
                      level="DEBUG", prefix=common.LOG_PREFIX_INCOMING)
             try:
                 current_temp = Temp(_current_temp)  # type: T.Optional[Temp]
@@ -6,13 +6,24 @@ import typing as T
 import types  # pylint: disable=unused-import
 if T.TYPE_CHECKING:
     # pylint: disable=cyclic-import,unused-import
+    import uuid
     from .room import Room
 
+import array
+import concurrent.futures
+import datetime
 import importlib
+import math
+import threading
+import traceback
 
 from .. import common
-from . import __version__, config, util
+from . import __version__, config, expression, util
 from .actor.base import ActorBase
+from .entity_watcher import EntityWatcher
+from .profiling import ExpressionProfiler
+from .state_publisher import StatePublisher
+from .timer_wheel import TimerWheel
 
 
 __all__ = ["SchedyApp"]
@@ -21,16 +32,37 @@ __all__ = ["SchedyApp"]
 class SchedyApp(common.App):
     """The Schedy app class for AppDaemon."""
 
+    # The app owns the helpers shared by all rooms, which reach them
+    # through it, so they are kept as attributes of their own.
+    # pylint: disable=too-many-instance-attributes
+
     class Meta(common.App.Meta):
         # pylint: disable=missing-docstring
         name = "schedy"
         version = __version__
         config_schema = config.CONFIG_SCHEMA
 
+    # maximum number of hours a schedy_forecast event may ask for
+    MAX_FORECAST_HOURS = 31 * 24
+
     def __init__(self, *args: T.Any, **kwargs: T.Any) -> None:
         self.actor_type = None  # type: T.Optional[T.Type[ActorBase]]
         self.rooms = []  # type: T.List[Room]
         self.expression_modules = {}  # type: T.Dict[str, types.ModuleType]
+        self.expression_env = None  # type: T.Optional[T.Mapping[str, T.Any]]
+        self.expression_functions = None  # type: T.Optional[expression.ExpressionFunctions]
+        self.timer_wheel = TimerWheel(self)
+        self.entity_watcher = EntityWatcher(self)
+        self.state_publisher = StatePublisher(self)
+        self.expression_cache = expression.ExpressionCache()
+        self.expression_profiler = None  # type: T.Optional[ExpressionProfiler]
+        self.expression_executor = None  # type: T.Optional[concurrent.futures.ThreadPoolExecutor]
+        self.scheduling_executor = None  # type: T.Optional[concurrent.futures.ThreadPoolExecutor]
+        self._log_buffer = threading.local()
+        self._service_call_semaphore = None  # type: T.Optional[threading.BoundedSemaphore]
+        self._reschedule_lock = threading.Lock()
+        self._reschedule_rooms = {}  # type: T.Dict[Room, bool]
+        self._reschedule_timer = None  # type: T.Optional[uuid.UUID]
         super().__init__(*args, **kwargs)
 
     def _check_accept_event(self, event: str, data: dict) -> bool:
@@ -46,6 +78,65 @@ class SchedyApp(common.App):
             return False
         return True
 
+    def _forecast_event_cb(
+            self, event: str, data: dict, kwargs: dict
+    ) -> None:
+        """This callback executes when a schedy_forecast event is received.
+        data may contain a "room" to limit the forecast to, the number of
+        "hours" to forecast (168 by default, capped at MAX_FORECAST_HOURS)
+        and "publish", which is either "event" (the default) to fire a
+        schedy_forecast_result event per room or "entity" to store the
+        forecast in an attribute of the
+        schedy.<app_name>_<room_name>_forecast entity."""
+
+        if not self._check_accept_event(event, data):
+            return
+
+        try:
+            hours = float(data.get("hours", 168))
+            if not math.isfinite(hours) or hours <= 0:
+                raise ValueError()
+            hours = min(hours, self.MAX_FORECAST_HOURS)
+            publish = data.get("publish", "event")
+            if publish not in ("event", "entity"):
+                raise ValueError()
+        except (TypeError, ValueError):
+            self.log("Ignoring {} event with invalid data: {}"
+                     .format(event, repr(data)),
+                     level="WARNING")
+            return
+
+        actor_type = self.actor_type
+        assert actor_type is not None
+
+        def serialize(value: T.Any) -> T.Optional[str]:
+            """Serializes value for the actor type, keeping None."""
+
+            if value is None:
+                return None
+            return actor_type.serialize_value(value)
+
+        rooms = self._get_event_rooms(event, data.get("room"))
+        forecasts = self.forecast(rooms, datetime.timedelta(hours=hours))
+        for room in rooms:
+            timestamps, values = forecasts[room.name]
+            forecast = [[timestamp, serialize(value)]
+                        for timestamp, value in zip(timestamps, values)]
+            self.log("Publishing forecast with {} values for {}."
+                     .format(len(forecast), room),
+                     level="DEBUG", prefix=common.LOG_PREFIX_OUTGOING)
+            if publish == "event":
+                self.fire_event(
+                    "schedy_forecast_result", app_name=self.name,
+                    room=room.name, forecast=forecast
+                )
+            else:
+                entity_id = "schedy.{}_{}_forecast".format(self.name, room.name)
+                self.set_state(
+                    entity_id, state=len(forecast),
+                    attributes={"forecast": forecast}
+                )
+
     def _get_event_rooms(
             self, event: str, room_names: T.Any
     ) -> T.Iterable["Room"]:
@@ -81,7 +172,12 @@ class SchedyApp(common.App):
         to the given room.
         mode has to be one of "reevaluate" (the default, only set the
         value when it changed) or "reset" (restart an eventually running
-        timer and start a new one with reset=True)."""
+        timer and start a new one with reset=True).
+        Rooms are re-scheduled together 3 seconds after the first of
+        several events received in a row, so that a steady stream of
+        events can't postpone re-scheduling. A room addressed by more
+        than one of them is re-scheduled only once, with reset=True
+        if any of the events requested it."""
 
         if not self._check_accept_event(event, data):
             return
@@ -99,10 +195,58 @@ class SchedyApp(common.App):
                          repr(mode)),
                  prefix=common.LOG_PREFIX_INCOMING)
 
-        for room in rooms:
-            # delay for some seconds to have the state fully updated
-            gen = lambda func, reset: lambda *a, **kw: func(reset=reset)
-            self.run_in(gen(room.apply_schedule, bool(mode == "reset")), 3)  # type: ignore
+        reset = mode == "reset"
+        with self._reschedule_lock:
+            for room in rooms:
+                self._reschedule_rooms[room] = \
+                    self._reschedule_rooms.get(room, False) or reset
+            if self._reschedule_timer is None:
+                # delay for some seconds to have the state fully updated
+                self._reschedule_timer = self.run_in(self._reschedule_cb, 3)
+
+    def _reschedule_cb(self, kwargs: dict) -> None:
+        """Applies the schedules of all rooms collected by
+        _reschedule_event_cb() in a single scheduling pass."""
+
+        with self._reschedule_lock:
+            self._reschedule_timer = None
+            pending, self._reschedule_rooms = self._reschedule_rooms, {}
+
+        self.log("Re-scheduling {} rooms.", len(pending),
+                 level="DEBUG")
+        self.run_for_rooms(
+            [room for room in self.rooms if room in pending],
+            lambda room: room.apply_schedule(reset=pending[room]),
+        )
+
+    def _call_for_room(
+            self, func: T.Callable[["Room"], T.Any], room: "Room",
+    ) -> None:
+        """Calls func for room, logging any exception it raises so that
+        the remaining rooms are processed nevertheless."""
+
+        try:
+            func(room)
+        except Exception as err:  # pylint: disable=broad-except
+            self.log("Error while scheduling {}: {!r}", room, err,
+                     level="ERROR")
+            self.log(traceback.format_exc(), level="DEBUG")
+
+    def _run_for_room(
+            self, func: T.Callable[["Room"], T.Any], room: "Room",
+            scheduling_pass: expression.SchedulingPass,
+            records: T.List[T.Tuple[str, str, T.Optional[str]]],
+    ) -> None:
+        """Calls func for room in a worker thread with the given
+        scheduling pass activated, collecting log messages in records
+        instead of writing them."""
+
+        self._log_buffer.records = records
+        try:
+            with scheduling_pass:
+                self._call_for_room(func, room)
+        finally:
+            self._log_buffer.records = None
 
     def _set_value_event_cb(
             self, event: str, data: dict, kwargs: dict
@@ -156,6 +300,33 @@ class SchedyApp(common.App):
                 rescheduling_delay=rescheduling_delay
             )
 
+    def call_service(  # pylint: disable=arguments-differ
+            self, service: str, **kwargs: T.Any
+    ) -> T.Any:
+        """Wrapper around super().call_service() which limits the
+        number of calls running at the same time when rooms are
+        scheduled in parallel."""
+
+        semaphore = self._service_call_semaphore
+        if semaphore is None:
+            return super().call_service(service, **kwargs)
+        with semaphore:
+            return super().call_service(service, **kwargs)
+
+    def forecast(
+            self, rooms: T.Optional[T.Iterable["Room"]] = None,
+            duration: datetime.timedelta = datetime.timedelta(days=7),
+    ) -> T.Dict[str, T.Tuple[array.array, T.List[T.Any]]]:
+        """Forecasts the values of the given rooms (all rooms by default)
+        for the given duration, starting now. A dict mapping room names
+        to the results of Room.forecast() is returned."""
+
+        if rooms is None:
+            rooms = self.rooms
+        start = self.datetime()
+        end = start + duration
+        return {room.name: room.forecast(start, end) for room in rooms}
+
     def get_room(self, room_name: str) -> T.Optional["Room"]:
         """Returns the room with given name or None, if no such room
         exists."""
@@ -190,8 +361,46 @@ class SchedyApp(common.App):
             else:
                 self.expression_modules[as_name] = mod
 
-        for room in self.rooms:
-            room.initialize(reset=self.cfg["reset_at_startup"])
+        self.expression_env = expression.build_base_env(self)
+        self.expression_functions = expression.ExpressionFunctions(
+            self.expression_env
+        )
+
+        if self.cfg["expression_timeout"] is not None:
+            self.log("Expressions are limited to {} seconds."
+                     .format(self.cfg["expression_timeout"]),
+                     level="DEBUG")
+            self.expression_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.cfg["expression_workers"]
+            )
+
+        if self.cfg["expression_profiling"]["enabled"]:
+            self.log("Expression profiling is enabled.",
+                     level="DEBUG")
+            self.expression_profiler = ExpressionProfiler(self)
+            self.expression_profiler.initialize()
+
+        if self.cfg["scheduling_workers"] > 1:
+            self.log("Scheduling rooms in {} threads.",
+                     self.cfg["scheduling_workers"],
+                     level="DEBUG")
+            self.scheduling_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.cfg["scheduling_workers"]
+            )
+            self._service_call_semaphore = threading.BoundedSemaphore(
+                self.cfg["max_parallel_service_calls"]
+            )
+
+        self.run_for_rooms(
+            self.rooms,
+            lambda room: room.initialize(reset=self.cfg["reset_at_startup"]),
+        )
+
+        cache_info = util.compile_cache_info()
+        self.log("Expression compile cache: {} hits, {} misses, {} / {} "
+                 "entries used.", cache_info.hits, cache_info.misses,
+                 cache_info.currsize, cache_info.maxsize,
+                 level="DEBUG")
 
         self.log("Listening for schedy_reschedule event.",
                  level="DEBUG")
@@ -200,3 +409,66 @@ class SchedyApp(common.App):
         self.log("Listening for schedy_set_value event.",
                  level="DEBUG")
         self.listen_event(self._set_value_event_cb, "schedy_set_value")
+
+        self.log("Listening for schedy_forecast event.",
+                 level="DEBUG")
+        self.listen_event(self._forecast_event_cb, "schedy_forecast")
+
+    def log(  # pylint: disable=arguments-differ
+            self, msg: T.Any, *args: T.Any, level: str = "INFO",
+            prefix: T.Optional[str] = None
+    ) -> None:
+        """Wrapper around super().log() which collects the messages
+        of rooms that are scheduled in parallel, so that run_for_rooms()
+        can write them in the order of the rooms afterwards."""
+
+        records = getattr(self._log_buffer, "records", None)
+        if records is None:
+            super().log(msg, *args, level=level, prefix=prefix)
+        elif self.is_log_level_enabled(level):
+            records.append((str(common.LogMessage(msg, args)), level, prefix))
+
+    def run_for_rooms(
+            self, rooms: T.Iterable["Room"],
+            func: T.Callable[["Room"], T.Any],
+    ) -> None:
+        """Calls func for each of the given rooms in a single scheduling
+        pass and returns when all calls have finished.
+        If scheduling_workers is greater than 1, the calls run in
+        parallel. Log messages are then written after all calls have
+        finished, grouped by room and in the order of rooms.
+        Exceptions raised by a call are logged and don't affect the
+        calls for other rooms."""
+
+        rooms = list(rooms)
+        with expression.SchedulingPass(self) as scheduling_pass:
+            # rooms are scheduled sequentially when called from one of
+            # the workers to not wait for the pool from inside of it
+            if self.scheduling_executor is None or len(rooms) < 2 or \
+               getattr(self._log_buffer, "records", None) is not None:
+                for room in rooms:
+                    self._call_for_room(func, room)
+                return
+
+            futures = []
+            for room in rooms:
+                records = []  # type: T.List[T.Tuple[str, str, T.Optional[str]]]
+                future = self.scheduling_executor.submit(
+                    self._run_for_room, func, room, scheduling_pass, records
+                )
+                futures.append((future, records))
+            concurrent.futures.wait([future for future, _ in futures])
+
+        for future, records in futures:
+            for msg, level, prefix in records:
+                super().log(msg, level=level, prefix=prefix)
+
+    def terminate(self) -> None:
+        """Writes pending room states and shuts the pools of expression
+        and scheduling workers down, if any."""
+
+        self.state_publisher.flush()
+        if self.expression_executor is not None:
+            self.expression_executor.shutdown(wait=False)
+        if self.scheduling_executor is not None:
+            self.scheduling_executor.shutdown(wait=False)
@@ -0,0 +1,284 @@
+"""
+This module implements a compiler that lowers schedules into flat
+programs, which can be evaluated without building rule paths.
+"""
+
+import typing as T
+if T.TYPE_CHECKING:
+    # pylint: disable=cyclic-import,unused-import
+    import datetime
+    import types
+    from .room import Room
+
+import weakref
+
+from . import expression, schedule
+
+
+# opcodes of the instructions a program consists of
+OP_ENTER = 0
+OP_MATCH = 1
+OP_LEAF = 2
+
+# returned by Program.run() when scheduling has been aborted
+ABORTED = object()
+
+
+class Leaf:
+    """Holds the data needed to evaluate a final rule of a program.
+    chain contains the rules with an expression or value along the
+    rule's path, from the rule itself up to the root schedule.
+    parent_chain is the same, just without the rule itself.
+    path is the rule's path from the program's schedule.
+    break_targets contains the program counter to continue at for each
+    number of levels a Break() result can skip inside the program."""
+
+    def __init__(
+            self, rule: schedule.Rule, chain: T.Tuple[schedule.Rule, ...],
+            parent_chain: T.Tuple[schedule.Rule, ...], depth: int,
+            path: schedule.RulePathNode,
+    ) -> None:
+        self.rule = rule
+        self.chain = chain
+        self.parent_chain = parent_chain
+        self.path = path
+        self.break_targets = [0] * (depth + 1)
+
+    def __repr__(self) -> str:
+        return "<Leaf {}>".format(self.rule)
+
+
+class Program:
+    """A schedule lowered into a flat list of instructions.
+    Each instruction is a tuple (opcode, depth, argument, target):
+    - OP_ENTER fetches the rules of the schedule given as argument that
+      are valid at the evaluation time and stores them for depth
+    - OP_MATCH jumps to target if the rule given as argument is not
+      among the valid rules stored for depth
+    - OP_LEAF evaluates the Leaf given as argument"""
+
+    def __init__(self, sched: schedule.Schedule) -> None:
+        self.schedule = sched
+        self.depth = 0
+        self._code = []  # type: T.List[T.List[T.Any]]
+        self._pending = []  # type: T.List[T.List[T.Tuple[Leaf, int]]]
+        self._compile(sched, 0, (), None)
+        self.code = tuple(tuple(instr) for instr in self._code)
+        del self._code, self._pending
+
+    def __repr__(self) -> str:
+        return "<Program for {} with {} instructions>" \
+               .format(self.schedule, len(self.code))
+
+    def _compile(
+            self, sched: schedule.Schedule, depth: int,
+            ancestors: T.Tuple[schedule.Rule, ...],
+            parent: T.Optional[schedule.RulePathNode],
+    ) -> None:
+        """Appends the instructions for the given schedule, located at
+        depth and reached through the given ancestor rules, whose path
+        is parent."""
+
+        code = self._code
+        self.depth = max(self.depth, depth + 1)
+        self._pending.append([])
+        code.append([OP_ENTER, depth, sched, None])
+        rules = tuple(sched.rules)
+        for pos, rule in enumerate(rules):
+            match_instr = [OP_MATCH, depth, rule, None]
+            code.append(match_instr)
+            path = ancestors + (rule,)
+            node = schedule.RulePathNode(
+                self.schedule, parent, rule, rules, pos
+            )
+            if isinstance(rule, schedule.SubScheduleRule):
+                self._compile(rule.sub_schedule, depth + 1, path, node)
+            else:
+                chain = tuple(
+                    _rule for _rule in reversed(path)
+                    if _rule.expr is not None or _rule.value is not None
+                )
+                if chain and chain[0] is rule:
+                    parent_chain = chain[1:]
+                else:
+                    parent_chain = chain
+                leaf = Leaf(rule, chain, parent_chain, depth, node)
+                code.append([OP_LEAF, depth, leaf, None])
+                # Break(levels) skips the rest of the schedule located
+                # at depth + 1 - levels
+                for levels in range(1, depth + 2):
+                    self._pending[depth + 1 - levels].append((leaf, levels - 1))
+            match_instr[3] = len(code)
+
+        for leaf, idx in self._pending.pop():
+            leaf.break_targets[idx] = len(code)
+
+    def run(  # pylint: disable=too-many-branches,too-many-locals,too-many-return-statements,too-many-statements
+            self, room: "Room", when: "datetime.datetime",
+            inherited_chain: T.Tuple[schedule.Rule, ...],
+            markers: T.Set[str], pre_results: T.List[T.Any],
+            expr_cache: T.Dict["types.CodeType", T.Any],
+            share_results: bool = True,
+    ) -> T.Any:
+        """Executes the program for the given room and time.
+        inherited_chain contains rules with expression or value to fall
+        back to after the chain of a leaf has been exhausted, which is
+        used for included schedules. share_results is passed on to
+        Room.eval_expr().
+        Returns a tuple of final result, markers and matched rule,
+        ABORTED, an int with the number of levels a Break() still has
+        to skip outside of this program or None, if the program ended
+        without a result."""
+
+        # pylint: disable=protected-access
+
+        actor_type = room.app.actor_type
+        code = self.code
+        end = len(code)
+        valid_rules = [()] * self.depth  # type: T.List[T.Tuple[schedule.Rule, ...]]
+        pc = 0
+        while pc < end:
+            opcode, depth, arg, target = code[pc]
+            pc += 1
+
+            if opcode == OP_MATCH:
+                if arg not in valid_rules[depth]:
+                    pc = target
+                continue
+
+            if opcode == OP_ENTER:
+                valid_rules[depth] = arg.get_matching_rules(when)
+                continue
+
+            leaf = arg
+            result = None
+            validated = False
+            for chain in (leaf.chain, inherited_chain):
+                for rule in chain:
+                    if actor_type in rule.folded_results:
+                        result = rule.folded_results[actor_type]
+                        validated = True
+                    elif rule.expr is not None:
+                        if rule.expr in expr_cache:
+                            result = expr_cache[rule.expr]
+                        else:
+                            expression.EntityRecorder.record(rule.entity_ids)
+                            result = room.eval_expr(
+                                rule.expr, when, leaf.path, share_results
+                            )
+                            expr_cache[rule.expr] = result
+                    else:
+                        result = rule.value
+                    if result is not None:
+                        break
+                if result is not None:
+                    break
+
+            room.log("{} => {!r}", leaf.rule, result,
+                     level="DEBUG")
+
+            if isinstance(result, expression.Mark):
+                markers.update(result.markers)
+                result = result.result
+
+            if result is None:
+                if leaf.chain or inherited_chain:
+                    room.log("All expressions returned None, skipping rule.",
+                             level="WARNING")
+                else:
+                    room.log("No expression/value definition found, "
+                             "skipping rule.",
+                             level="WARNING")
+            elif isinstance(result, Exception):
+                room.log("Evaluation failed, skipping rule.",
+                         level="DEBUG")
+            elif isinstance(result, expression.Abort):
+                return ABORTED
+            elif isinstance(result, expression.Break):
+                if result.levels > len(leaf.break_targets):
+                    return result.levels - len(leaf.break_targets)
+                pc = leaf.break_targets[result.levels - 1]
+            elif isinstance(result, expression.IncludeSchedule):
+                outcome = compile_schedule(result.schedule).run(
+                    room, when, leaf.parent_chain + inherited_chain,
+                    markers, pre_results, expr_cache, share_results
+                )
+                if isinstance(outcome, int):
+                    # the Break() continues as if it was returned here
+                    if outcome > len(leaf.break_targets):
+                        return outcome - len(leaf.break_targets)
+                    pc = leaf.break_targets[outcome - 1]
+                elif outcome is not None:
+                    return outcome
+            elif isinstance(result, expression.PreliminaryResult):
+                if isinstance(result, expression.PreliminaryValidationMixin) \
+                   and not validated:
+                    value = room._validate_value(result.value)
+                    if value is None:
+                        room.log("Aborting scheduling",
+                                 level="ERROR")
+                        return ABORTED
+                    result.value = value
+                pre_results.append(result)
+            elif isinstance(result, expression.Skip):
+                continue
+            else:
+                if not validated:
+                    result = room._validate_value(result)
+                for pre_result in pre_results:
+                    if result is None:
+                        break
+                    room.log("+ {!r}", pre_result,
+                             level="DEBUG")
+                    try:
+                        result = pre_result.combine_with(result)
+                    except expression.PreliminaryCombiningError as err:
+                        room.log("Error while combining {} with result {}: {}"
+                                 .format(repr(pre_result), repr(result), err),
+                                 level="ERROR")
+                        result = None
+                        break
+                    room.log("= {!r}", result,
+                             level="DEBUG")
+                    result = room._validate_value(result)
+                if result is None:
+                    room.log("Aborting scheduling",
+                             level="ERROR")
+                    return ABORTED
+                return result, markers, leaf.rule
+
+        return None
+
+    def evaluate(
+            self, room: "Room", when: "datetime.datetime",
+            share_results: bool = True,
+    ) -> T.Optional[T.Tuple[T.Any, T.Set[str], schedule.Rule]]:
+        """Evaluates the program like Room.eval_schedule() evaluates
+        the schedule it was compiled from."""
+
+        outcome = self.run(room, when, (), set(), [], {}, share_results)
+        if isinstance(outcome, tuple):
+            room.log("Final result: {!r}", outcome[0],
+                     level="DEBUG")
+            return outcome
+
+        room.log("Found no result.", level="DEBUG")
+        return None
+
+
+# compiled programs, together with the path table they were compiled for
+_PROGRAMS = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+
+
+def compile_schedule(sched: schedule.Schedule) -> Program:
+    """Returns the program for the given schedule, compiling it if it
+    hasn't been compiled before or the schedule has changed since."""
+
+    table = sched.get_path_table()
+    cached = _PROGRAMS.get(sched)  # type: T.Optional[T.Tuple[T.Any, Program]]
+    if cached is not None and cached[0] is table:
+        return cached[1]
+
+    program = Program(sched)
+    _PROGRAMS[sched] = (table, program)
+    return program
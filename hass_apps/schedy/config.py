@@ -6,7 +6,7 @@ import typing as T
 
 import voluptuous as vol
 
-from . import actor, schedule, util
+from . import actor, expression, schedule, util
 from .room import Room
 
 
@@ -20,6 +20,7 @@ def build_schedule_rule(rule: dict) -> schedule.Rule:
             constraints[name] = value
 
     kwargs = {
+        "name": rule["name"],
         "start_time": rule["start"],
         "end_time": rule["end"],
         "end_plus_days": rule["end_plus_days"],
@@ -29,16 +30,31 @@ def build_schedule_rule(rule: dict) -> schedule.Rule:
     }
 
     if "rules" in rule:
-        return schedule.SubScheduleRule(rule["rules"], **kwargs)
-    return schedule.Rule(**kwargs)
+        return schedule.SubScheduleRule.interned(rule["rules"], **kwargs)
+    return schedule.Rule.interned(**kwargs)
 
 def build_schedule(rules: T.Iterable[dict]) -> schedule.Schedule:
     """Compiles the given rules and returns a schedule containing them."""
 
-    sched = schedule.Schedule()
-    for rule in rules:
-        sched.rules.append(build_schedule_rule(rule))
-    return sched
+    return schedule.Schedule(
+        rules=[build_schedule_rule(rule) for rule in rules]
+    )
+
+def fold_schedule_constants(
+        sched: schedule.Schedule, actor_type: T.Type[actor.ActorBase]
+) -> None:
+    """Pre-evaluates the constant expressions and values of all rules
+    in the given schedule and its sub-schedules for actor_type and
+    stores the validated results in the rules' folded_results."""
+
+    for entry in sched.get_path_table():
+        rule = entry.rule
+        if actor_type in rule.folded_results or \
+           (rule.expr_raw is None and rule.value is None):
+            continue
+        result = expression.fold_constant(rule.expr_raw, rule.value, actor_type)
+        if result is not None:
+            rule.folded_results[actor_type] = result
 
 def config_post_hook(cfg: dict) -> dict:
     """Creates Room and other objects after config has been parsed."""
@@ -51,6 +67,9 @@ def config_post_hook(cfg: dict) -> dict:
 
     actor_type = cfg["actor_type"]
 
+    for sched in cfg["schedule_snippets"].values():
+        fold_schedule_constants(sched, actor_type)
+
     # Build room objects.
     rooms = []
     for room_name, room_data in cfg["rooms"].items():
@@ -75,6 +94,7 @@ def config_post_hook(cfg: dict) -> dict:
         sched = cfg["schedule_prepend"] + room_data["schedule"] + \
                 cfg["schedule_append"]
         sched.name = room_name
+        fold_schedule_constants(sched, actor_type)
 
         del room_data["actors"]
         del room_data["schedule"]
@@ -108,11 +128,12 @@ def validate_rule_paths(sched: schedule.Schedule) -> schedule.Schedule:
     each path contains at least one rule with an expression or value.
     A ValueError is raised when this check fails."""
 
-    for path in sched.unfold():
-        if path.is_final and not list(path.rules_with_expr_or_value):
+    for table_index, entry in enumerate(sched.get_path_table()):
+        if not isinstance(entry.rule, schedule.SubScheduleRule) and \
+           not entry.has_expr_or_value:
             raise ValueError(
                 "No expression or value specified along the path {}."
-                .format(path)
+                .format(sched.get_rule_path(table_index))
             )
 
     return sched
@@ -159,6 +180,18 @@ EXPRESSION_MODULES_SCHEMA = vol.Schema(vol.All(
     },
 ))
 
+EXPRESSION_PROFILING_SCHEMA = vol.Schema(vol.All(
+    lambda v: v or {},
+    {
+        vol.Optional("enabled", default=False): bool,
+        vol.Optional("publish_interval", default=60):
+            vol.All(int, vol.Range(min=1)),
+        vol.Optional("slow_threshold", default=0.1):
+            vol.All(vol.Any(float, int), vol.Range(min=0)),
+        vol.Optional("top", default=20): vol.All(int, vol.Range(min=1)),
+    },
+))
+
 
 ########## ACTORS
 
@@ -234,8 +267,24 @@ CONFIG_SCHEMA = vol.Schema(vol.All(
     vol.Schema({
         vol.Optional("reset_at_startup", default=False): bool,
         vol.Optional("expressions_from_events", default=False): bool,
+        vol.Optional("compile_schedules", default=False): bool,
+        vol.Optional("reevaluate_on_state_change", default=False): bool,
+        vol.Optional("share_expression_results", default=False): bool,
         vol.Optional("expression_modules", default=dict):
             EXPRESSION_MODULES_SCHEMA,
+        vol.Optional("expression_profiling", default=dict):
+            EXPRESSION_PROFILING_SCHEMA,
+        vol.Optional("expression_timeout", default=None): vol.Any(
+            None, vol.All(vol.Any(float, int), vol.Range(min=0, min_included=False)),
+        ),
+        vol.Optional("expression_workers", default=4):
+            vol.All(int, vol.Range(min=1)),
+        vol.Optional("scheduling_workers", default=1):
+            vol.All(int, vol.Range(min=1)),
+        vol.Optional("max_parallel_service_calls", default=4):
+            vol.All(int, vol.Range(min=1)),
+        vol.Optional("state_publish_delay", default=0):
+            vol.All(vol.Any(float, int), vol.Range(min=0)),
         vol.Required("actor_type"): vol.All(
             vol.Any(*map(lambda a: a.name, actor.get_actor_types())),
             lambda n: {a.name: a for a in actor.get_actor_types()}[n],
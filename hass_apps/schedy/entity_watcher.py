@@ -0,0 +1,95 @@
+"""
+This module implements the EntityWatcher class.
+"""
+
+import typing as T
+if T.TYPE_CHECKING:
+    # pylint: disable=cyclic-import,unused-import
+    from .app import SchedyApp
+    from .room import Room
+
+import threading
+
+from .. import common
+
+
+class EntityWatcher:
+    """Re-evaluates the schedules of rooms when entities their last
+    evaluation depended on change. Cached expression results depending
+    on an entity are dropped when it changes as well, which is all that
+    happens when only share_expression_results is enabled.
+    Rooms tell which entities they depend on and only one state listener
+    per entity is registered, no matter how many rooms depend on it."""
+
+    def __init__(self, app: "SchedyApp") -> None:
+        self.app = app
+
+        self._lock = threading.Lock()
+        self._entities_by_room = {}  # type: T.Dict[Room, T.FrozenSet[str]]
+        self._rooms_by_entity = {}  # type: T.Dict[str, T.Set[Room]]
+        self._handles = {}  # type: T.Dict[str, T.Any]
+
+    def __repr__(self) -> str:
+        return "<EntityWatcher for {} entities>" \
+               .format(len(self._rooms_by_entity))
+
+    def _state_cb(
+            self, entity: str, attr: str, old: T.Any, new: T.Any,
+            kwargs: dict,
+    ) -> None:
+        """Drops the cached expression results for the entity that
+        changed and re-evaluates the schedules of all rooms depending
+        on it, if reevaluate_on_state_change is enabled."""
+
+        if old == new:
+            return
+
+        self.app.expression_cache.invalidate(entity)
+        if not self.app.cfg["reevaluate_on_state_change"]:
+            return
+
+        with self._lock:
+            rooms = self._rooms_by_entity.get(entity, set()).copy()
+
+        self.app.log("State of {} changed, re-evaluating {} rooms.",
+                     entity, len(rooms),
+                     level="DEBUG", prefix=common.LOG_PREFIX_INCOMING)
+        self.app.run_for_rooms(
+            [room for room in self.app.rooms if room in rooms],
+            lambda room: room.apply_schedule(),
+        )
+
+    def update(self, room: "Room", entity_ids: T.Iterable[str]) -> None:
+        """Sets the entities the given room depends on, replacing the
+        ones set before. Listeners for entities no room depends on
+        anymore are cancelled."""
+
+        entity_ids = frozenset(entity_ids)
+        with self._lock:
+            previous = self._entities_by_room.get(room, frozenset())
+            if entity_ids == previous:
+                return
+            self._entities_by_room[room] = entity_ids
+
+            for entity_id in entity_ids - previous:
+                rooms = self._rooms_by_entity.setdefault(entity_id, set())
+                if not rooms:
+                    self.app.log("Listening for state changes of {}."
+                                 .format(entity_id),
+                                 level="DEBUG")
+                    self._handles[entity_id] = self.app.listen_state(
+                        self._state_cb, entity_id, attribute="all"
+                    )
+                rooms.add(room)
+
+            for entity_id in previous - entity_ids:
+                rooms = self._rooms_by_entity[entity_id]
+                rooms.discard(room)
+                if not rooms:
+                    del self._rooms_by_entity[entity_id]
+                    self.app.log("No longer listening for state changes "
+                                 "of {}.".format(entity_id),
+                                 level="DEBUG")
+                    self.app.cancel_listen_state(
+                        self._handles.pop(entity_id)
+                    )
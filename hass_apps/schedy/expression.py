@@ -8,8 +8,18 @@ if T.TYPE_CHECKING:
     # pylint: disable=cyclic-import,unused-import
     from . import schedule
     from .app import SchedyApp
+    from .actor.base import ActorBase
 
+import builtins
+import concurrent.futures
+import copy
 import datetime
+import functools
+import sys
+import threading
+import weakref
+
+from . import util
 
 
 __all__ = [
@@ -18,6 +28,12 @@ __all__ = [
 ]
 
 
+class ExpressionTimeoutError(Exception):
+    """Raised when an expression didn't finish within the configured
+    expression_timeout."""
+
+    pass
+
 class PreliminaryCombiningError(Exception):
     """Raised when PreliminaryResult.combine_with() fails."""
 
@@ -181,24 +197,263 @@ class Skip(ControlResult):
         return "Skip()"
 
 
-def build_expr_env(app: "SchedyApp") -> T.Dict[str, T.Any]:
-    """This function builds and returns an environment usable as globals
-    for the evaluation of an expression. It will add all members
-    of this module's __all__ to the environment. Additionally, some
-    helpers will be constructed based on the SchedyApp object"""
+class EntityRecorder:
+    """A context manager recording the ids of all entities read by
+    expressions that are evaluated in the current thread while it's
+    active. Recorders may be nested, the innermost one records and
+    passes what it recorded on to the outer one when exiting."""
+
+    _local = threading.local()
+
+    def __init__(self) -> None:
+        self.entity_ids = set()  # type: T.Set[str]
+        self._previous = None  # type: T.Optional[EntityRecorder]
+
+    def __enter__(self) -> "EntityRecorder":
+        self._previous = getattr(self._local, "recorder", None)
+        self._local.recorder = self
+        return self
+
+    def __exit__(self, *args: T.Any) -> None:
+        self._local.recorder = self._previous
+        if self._previous is not None:
+            self._previous.entity_ids.update(self.entity_ids)
+        self._previous = None
+
+    @classmethod
+    def record(cls, entity_ids: T.Iterable[str]) -> None:
+        """Adds the given entity ids to the active recorder, if any."""
+
+        recorder = getattr(cls._local, "recorder", None)
+        if recorder is not None:
+            recorder.entity_ids.update(entity_ids)
+
+
+class SchedulingPass:
+    """A context manager for evaluating the schedules of one or more
+    rooms as a single pass. While a pass is active in the current
+    thread, the state() helper of expressions reads every entity from
+    Home Assistant only once and serves all further lookups from that
+    snapshot, so that all rooms see the same states.
+    The moment the pass was created at, in whole seconds so that rooms
+    can share cached expression results, is available as now and
+    should be used as the time to evaluate schedules for.
+    Entering a pass while another one of the same app is active in the
+    current thread yields the outer pass. A pass can be activated in
+    other threads by entering it there as well."""
+
+    _local = threading.local()
+
+    def __init__(self, app: "SchedyApp") -> None:
+        self.app = app
+        self.now = app.datetime().replace(microsecond=0)
+        self._lock = threading.Lock()
+        self._states = {}  # type: T.Dict[str, T.Any]
+        self._outer = {}  # type: T.Dict[int, T.Optional[SchedulingPass]]
+
+    def __repr__(self) -> str:
+        return "<SchedulingPass with {} entities>".format(len(self._states))
+
+    def __enter__(self) -> "SchedulingPass":
+        outer = getattr(self._local, "current", None)  # type: T.Optional[SchedulingPass]
+        if outer is not None and outer is not self and outer.app is self.app:
+            return outer
+        self._outer[threading.get_ident()] = outer
+        self._local.current = self
+        return self
+
+    def __exit__(self, *args: T.Any) -> None:
+        if getattr(self._local, "current", None) is self:
+            self._local.current = self._outer.pop(threading.get_ident())
+
+    @classmethod
+    def current(cls, app: "SchedyApp") -> T.Optional["SchedulingPass"]:
+        """Returns the pass of the given app that is active in the
+        current thread, if any."""
+
+        current = getattr(cls._local, "current", None)  # type: T.Optional[SchedulingPass]
+        if current is not None and current.app is app:
+            return current
+        return None
+
+    def get_state(
+            self, entity_id: str = None, attribute: str = None,
+            **kwargs: T.Any
+    ) -> T.Any:
+        """Behaves like app.get_state(), but fetches the complete state
+        of each entity only once. Lookups that don't address a single
+        entity are passed through to app.get_state()."""
+
+        if entity_id is None or "." not in entity_id or kwargs:
+            return self.app.get_state(entity_id, attribute=attribute, **kwargs)
+
+        with self._lock:
+            try:
+                full_state = self._states[entity_id]
+            except KeyError:
+                full_state = self.app.get_state(entity_id, attribute="all")
+                self._states[entity_id] = full_state
+
+        if not isinstance(full_state, dict):
+            return None
+        if attribute is None:
+            return full_state.get("state")
+        if attribute == "all":
+            return full_state
+        attributes = full_state.get("attributes") or {}
+        if attribute in attributes:
+            return attributes[attribute]
+        return full_state.get(attribute)
+
+
+class ExpressionCache:
+    """Shares the results of expressions between the rooms of an app.
+    Results are only valid for the instant they were evaluated for and
+    are dropped as soon as an evaluation for another instant happens or
+    an entity they depend on changes. Only expressions that can't
+    produce different results for different rooms are cached."""
+
+    # names whose use makes an expression's result depend on the room
+    ROOM_SCOPED_NAMES = frozenset((
+        "room_name", "globals", "locals", "vars", "eval", "exec",
+    ))
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._when = None  # type: T.Optional[datetime.datetime]
+        self._results = {}  # type: T.Dict[types.CodeType, T.Tuple[T.Any, T.Set[str]]]
+        # weak, so that expressions dropped on recompilation don't pile up
+        self._shareable = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+
+    def __repr__(self) -> str:
+        return "<ExpressionCache with {} results>".format(len(self._results))
+
+    def is_shareable(self, expr: types.CodeType) -> bool:
+        """Tells whether results of the given expression may be shared
+        between rooms."""
+
+        shareable = self._shareable.get(expr)
+        if shareable is None:
+            names = util.get_code_names(expr)
+            shareable = not names & self.ROOM_SCOPED_NAMES
+            self._shareable[expr] = shareable
+        return shareable
+
+    def get(
+            self, expr: types.CodeType, when: datetime.datetime
+    ) -> T.Tuple[bool, T.Any]:
+        """Returns a tuple of whether a result is cached for the given
+        expression and instant and the result itself. The entities the
+        result depends on are recorded by the active EntityRecorder."""
+
+        with self._lock:
+            if when != self._when or expr not in self._results:
+                return False, None
+            result, entity_ids = self._results[expr]
+        EntityRecorder.record(entity_ids)
+        return True, result
+
+    def put(
+            self, expr: types.CodeType, when: datetime.datetime,
+            result: T.Any, entity_ids: T.Set[str],
+    ) -> None:
+        """Caches the result of the given expression for the instant
+        when. Results cached for other instants are dropped."""
+
+        with self._lock:
+            if when != self._when:
+                self._results.clear()
+                self._when = when
+            self._results[expr] = (result, entity_ids)
+
+    def invalidate(self, entity_id: str = None) -> None:
+        """Drops the results depending on the given entity or all
+        results, if no entity is given."""
+
+        with self._lock:
+            if entity_id is None:
+                self._results.clear()
+                return
+            for expr, (_, entity_ids) in list(self._results.items()):
+                if entity_id in entity_ids:
+                    del self._results[expr]
+
+
+class ExpressionFunctions:
+    """Binds the functions util.compile_expression() wraps simple
+    expressions into to the base environment of an app, so that they
+    can be evaluated by a plain function call. Functions of expressions
+    belonging to a schedule rule are bound per rule and named after it,
+    so that tracebacks and profilers tell the rules apart."""
+
+    def __init__(self, base_env: T.Mapping[str, T.Any]) -> None:
+        self.globals = dict(base_env)
+        # Functions don't add the builtins to their globals on their
+        # own before Python 3.10, unlike eval() and exec().
+        self.globals.setdefault("__builtins__", builtins)
+        self._lock = threading.Lock()
+        self._functions = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+        self._rule_functions = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+
+    def __repr__(self) -> str:
+        return "<ExpressionFunctions with {} functions>" \
+               .format(len(self._functions) + len(self._rule_functions))
+
+    def get(
+            self, expr: types.CodeType, rule: "schedule.Rule" = None
+    ) -> T.Optional[types.FunctionType]:
+        """Returns the function for the given expression or None, if it
+        hasn't been wrapped into one. rule is the schedule rule expr
+        belongs to, if any."""
+
+        functions = self._functions
+        key = expr  # type: T.Any
+        if rule is not None:
+            functions, key = self._rule_functions, rule
+
+        func = functions.get(key)
+        if func is None:
+            func_code = util.get_function_code(expr)
+            if func_code is None:
+                return None
+            if rule is not None and sys.version_info >= (3, 8):
+                func_code = func_code.replace(co_name=repr(rule))
+            func = types.FunctionType(func_code, self.globals)
+            with self._lock:
+                functions[key] = func
+        return func
+
+
+def build_base_env(app: "SchedyApp") -> T.Mapping[str, T.Any]:
+    """Builds and returns the part of the environment for expression
+    evaluation that doesn't change between evaluations. It contains
+    all members of this module's __all__, some helpers constructed
+    based on the SchedyApp object, the configured expression_modules
+    and the items added by the app's actor type.
+    A read-only view is returned, build_expr_env() copies it."""
+
+    def state(
+            entity_id: str = None, attribute: str = None, **kwargs: T.Any
+    ) -> T.Any:
+        """Wrapper around app.get_state() that records the entity
+        read and uses the active SchedulingPass, if any."""
+
+        if entity_id is not None and "." in entity_id:
+            EntityRecorder.record((entity_id,))
+        scheduling_pass = SchedulingPass.current(app)
+        if scheduling_pass is not None:
+            return scheduling_pass.get_state(
+                entity_id, attribute=attribute, **kwargs
+            )
+        return app.get_state(entity_id, attribute=attribute, **kwargs)
 
-    # use date/time provided by appdaemon to support time-traveling
-    now = app.datetime()
     env = {
         "app": app,
         "schedule_snippets": app.cfg["schedule_snippets"],
         "datetime": datetime,
-        "now": now,
-        "date": now.date(),
-        "time": now.time(),
-        "state": app.get_state,
-        "is_on": lambda _id: str(app.get_state(_id)).lower() == "on",
-        "is_off": lambda _id: str(app.get_state(_id)).lower() == "off",
+        "state": state,
+        "is_on": lambda _id: str(state(_id)).lower() == "on",
+        "is_off": lambda _id: str(state(_id)).lower() == "off",
     }
 
     globs = globals()
@@ -207,19 +462,193 @@ def build_expr_env(app: "SchedyApp") -> T.Dict[str, T.Any]:
 
     env.update(app.expression_modules)
 
+    if app.actor_type is not None:
+        app.actor_type.prepare_eval_environment(env)
+
+    return types.MappingProxyType(env)
+
+def build_expr_env(
+        app: "SchedyApp", when: T.Optional[datetime.datetime] = None
+) -> T.Dict[str, T.Any]:
+    """This function builds and returns an environment usable as globals
+    for the evaluation of an expression. It copies the app's base
+    environment (see build_base_env()) and adds the items returned by
+    build_expr_locals()."""
+
+    base_env = app.expression_env
+    if base_env is None:
+        base_env = build_base_env(app)
+
+    env = dict(base_env)
+    env.update(build_expr_locals(app, when))
     return env
 
+def build_expr_locals(
+        app: "SchedyApp", when: T.Optional[datetime.datetime] = None
+) -> T.Dict[str, T.Any]:
+    """Returns the part of the environment for expression evaluation
+    that changes between evaluations, namely now, date and time, which
+    are taken from when or, if not given, from the date and time
+    provided by AppDaemon. Names taken by one of the expression_modules
+    are left out, because modules take precedence over these."""
+
+    # use date/time provided by appdaemon to support time-traveling
+    now = app.datetime() if when is None else when
+    env = {"now": now, "date": now.date(), "time": now.time()}
+    for name in app.expression_modules:
+        env.pop(name, None)
+    return env
+
+def build_constant_env(
+        actor_type: T.Type["ActorBase"]
+) -> T.Dict[str, T.Any]:
+    """Builds the environment constant expressions are evaluated in.
+    It only contains the members of this module's __all__ and the items
+    added by the given actor type, but nothing that depends on time,
+    state or the app."""
+
+    globs = globals()
+    env = {name: globs[name] for name in __all__ if name != "IncludeSchedule"}
+    actor_type.prepare_eval_environment(env)
+    return env
+
+def fold_constant(
+        expr_raw: T.Optional[str], value: T.Any,
+        actor_type: T.Type["ActorBase"],
+) -> T.Any:
+    """Evaluates the given expression, if it's constant, or takes the
+    given value and validates the result for the given actor type like
+    Room.eval_schedule() would do.
+    The validated result is returned. None is returned if the expression
+    is not constant or evaluation or validation fail, leaving these
+    cases to be handled at runtime."""
+
+    if expr_raw is not None:
+        env = build_constant_env(actor_type)
+        if not util.is_constant_expression(expr_raw, env):
+            return None
+        try:
+            value = eval(expr_raw, env)  # pylint: disable=eval-used
+        except Exception:  # pylint: disable=broad-except
+            return None
+
+    return _prevalidate(value, actor_type)
+
+def _prevalidate(result: T.Any, actor_type: T.Type["ActorBase"]) -> T.Any:
+    """Validates the value contained in the given result, if any, and
+    returns the result with the validated value, or None if validation
+    failed."""
+
+    if isinstance(result, Mark):
+        inner = _prevalidate(result.result, actor_type)
+        if inner is None:
+            return None
+        return Mark(inner, *result.markers)
+
+    if isinstance(result, (type(None), Exception, IncludeSchedule)):
+        return None
+
+    try:
+        if isinstance(result, PreliminaryValidationMixin):
+            result = copy.copy(result)
+            result.value = actor_type.validate_value(result.value)
+            if result.value is None:
+                return None
+        elif not isinstance(result, (ControlResult, PreliminaryResult)):
+            result = actor_type.validate_value(result)
+    except ValueError:
+        return None
+
+    return result
+
 def eval_expr(
         expr: types.CodeType, app: "SchedyApp",
-        extra_env: T.Optional[T.Dict[str, T.Any]] = None
+        extra_env: T.Optional[T.Dict[str, T.Any]] = None,
+        when: T.Optional[datetime.datetime] = None,
+        room_name: T.Optional[str] = None,
+        rule: "schedule.Rule" = None,
 ) -> T.Any:
     """This method evaluates the given expression. The evaluation result
     is returned. The items of the extra_env dict are added to the globals
-    available during evaluation."""
-
-    env = build_expr_env(app)
-    if extra_env:
-        env.update(extra_env)
-
-    exec(expr, env)  # pylint: disable=exec-used
-    return env.get("result")
+    available during evaluation. when is passed to build_expr_env().
+    room_name is made available to the expression, if given.
+    Simple expressions are evaluated by calling the function they've
+    been wrapped into when compiling, if the app has ExpressionFunctions,
+    no extra_env is given and none of the expression_modules is named
+    like one of the function's arguments. The function is named after
+    rule, the schedule rule expr belongs to, if given.
+    If the app has an expression_executor, the expression runs in one of
+    its threads and ExpressionTimeoutError is raised when it doesn't
+    finish within the configured expression_timeout. The expression
+    keeps running in the background then, since threads can't be
+    stopped."""
+
+    functions = app.expression_functions
+    func = None
+    if functions is not None and not extra_env and \
+       app.expression_modules.keys().isdisjoint(
+           util.EXPRESSION_FUNCTION_ARGS
+       ):
+        func = functions.get(expr, rule)
+
+    if func is not None:
+        # use date/time provided by appdaemon to support time-traveling
+        now = app.datetime() if when is None else when
+        run = functools.partial(func, now, now.date(), now.time(), room_name)
+    else:
+        if functions is not None and util.is_flat_code(expr):
+            # Everything that changes between evaluations goes into the
+            # locals, which are looked up before the shared globals, so
+            # that the base environment needn't be copied.
+            env = functions.globals
+            local_env = build_expr_locals(app, when)
+        else:
+            # Nested scopes don't see the locals and assignments to
+            # globals would modify the shared ones, hence a copy.
+            env = build_expr_env(app, when)
+            local_env = env
+        if room_name is not None:
+            local_env["room_name"] = room_name
+        if extra_env:
+            local_env.update(extra_env)
+        run = functools.partial(
+            util.exec_expression, expr, env, local_env
+        )
+
+    executor = app.expression_executor
+    if executor is None:
+        return run()
+
+    # run in a worker thread, taking the thread-local context along
+    recorder = EntityRecorder()
+    future = executor.submit(
+        _run_in_context, run, recorder, SchedulingPass.current(app)
+    )
+    timeout = app.cfg["expression_timeout"]
+    try:
+        result = future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        # The entities aren't recorded, because the expression may
+        # still be running and reading them.
+        future.cancel()
+        raise ExpressionTimeoutError(
+            "expression didn't finish within {} seconds".format(timeout)
+        ) from None
+    except Exception:
+        EntityRecorder.record(recorder.entity_ids)
+        raise
+    EntityRecorder.record(recorder.entity_ids)
+    return result
+
+def _run_in_context(
+        run: T.Callable[[], T.Any], recorder: EntityRecorder,
+        scheduling_pass: T.Optional[SchedulingPass],
+) -> T.Any:
+    """Calls run with the given recorder and scheduling pass activated
+    in the current thread and returns its result."""
+
+    with recorder:
+        if scheduling_pass is None:
+            return run()
+        with scheduling_pass:
+            return run()
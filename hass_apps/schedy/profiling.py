@@ -0,0 +1,160 @@
+"""
+This module implements the ExpressionProfiler class.
+"""
+
+import types
+import typing as T
+if T.TYPE_CHECKING:
+    # pylint: disable=cyclic-import,unused-import
+    from .app import SchedyApp
+    from .schedule import RulePathNode
+
+import datetime
+import threading
+
+from .. import common
+from . import util
+
+
+class ExpressionStats:
+    """Execution statistics of a single expression."""
+
+    __slots__ = ("label", "calls", "total_time", "max_time", "errors")
+
+    def __init__(self, label: str) -> None:
+        self.label = label
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.errors = 0
+
+    def __repr__(self) -> str:
+        return "<ExpressionStats for {}: {} calls>" \
+               .format(self.label, self.calls)
+
+    def serialize(self) -> T.Dict[str, T.Any]:
+        """Returns the statistics as a JSON-serializable dict, with
+        times converted to milliseconds."""
+
+        return {
+            "expression": self.label,
+            "calls": self.calls,
+            "total_ms": round(self.total_time * 1000, 3),
+            "avg_ms": round(self.total_time * 1000 / max(1, self.calls), 3),
+            "max_ms": round(self.max_time * 1000, 3),
+            "errors": self.errors,
+        }
+
+
+class ExpressionProfiler:
+    """Records how often and how long expressions run and publishes a
+    summary as the schedy.<app_name>_profile entity.
+    Expressions of schedules are told apart by the room or actor that
+    evaluated them and their rule path, other ones, such as custom actor
+    hooks, by the owner and their code object. Apps without expression
+    profiling enabled don't create a profiler at all."""
+
+    def __init__(self, app: "SchedyApp") -> None:
+        self.app = app
+        self.cfg = app.cfg["expression_profiling"]
+
+        self._lock = threading.Lock()
+        self._stats = {}  # type: T.Dict[T.Tuple, ExpressionStats]
+
+    def __repr__(self) -> str:
+        return "<ExpressionProfiler for {} expressions>" \
+               .format(len(self._stats))
+
+    @staticmethod
+    def _describe(
+            expr: types.CodeType, owner: T.Any,
+            path: T.Optional["RulePathNode"],
+    ) -> str:
+        """Builds a label for the given expression, which has been
+        evaluated by owner (a room or an actor) at path, if given."""
+
+        if path is not None:
+            return "{}: {}".format(owner, path)
+
+        cfg = getattr(owner, "cfg", {})
+        for key, value in cfg.items():
+            if value is expr:
+                return "{}: {}".format(owner, key)
+
+        return "{}: ad-hoc expression".format(owner)
+
+    def _publish_cb(self, kwargs: dict) -> None:
+        """Publishes the statistics of the most expensive expressions
+        and of the compile cache as attributes of the
+        schedy.<app_name>_profile entity."""
+
+        with self._lock:
+            stats = sorted(
+                self._stats.values(), key=lambda s: s.total_time, reverse=True
+            )
+            expressions = [s.serialize() for s in stats[:self.cfg["top"]]]
+
+        cache_info = util.compile_cache_info()
+        compile_cache = {
+            "hits": cache_info.hits,
+            "misses": cache_info.misses,
+            "size": cache_info.currsize,
+            "maxsize": cache_info.maxsize,
+        }
+
+        entity_id = "schedy.{}_profile".format(self.app.name)
+        self.app.log("Publishing profile of {} expressions to {}.",
+                     len(stats), entity_id,
+                     level="DEBUG", prefix=common.LOG_PREFIX_OUTGOING)
+        self.app.set_state(
+            entity_id, state=len(stats),
+            attributes={
+                "expressions": expressions,
+                "compile_cache": compile_cache,
+            }
+        )
+
+    def initialize(self) -> None:
+        """Starts publishing the statistics periodically."""
+
+        interval = self.cfg["publish_interval"]
+        self.app.run_every(
+            self._publish_cb,
+            self.app.datetime() + datetime.timedelta(seconds=interval),
+            interval,
+        )
+
+    def record(
+            self, expr: types.CodeType, duration: float, failed: bool,
+            owner: T.Any, path: T.Optional["RulePathNode"] = None,
+    ) -> None:
+        """Records an execution of expr by owner (a room or an actor)
+        that took duration seconds. path is the rule path expr was
+        evaluated for, it may end below the rule expr belongs to.
+        A warning is logged if it took longer than the configured
+        slow_threshold."""
+
+        # find the rule the expression belongs to
+        node = path
+        if path is not None:
+            node = path.find_expr_node(expr) or path
+
+        if node is None:
+            key = (owner, expr)  # type: T.Tuple
+        else:
+            key = (owner, node.root_schedule, node.get_rules())
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = ExpressionStats(self._describe(expr, owner, node))
+                self._stats[key] = stats
+            stats.calls += 1
+            stats.total_time += duration
+            stats.max_time = max(stats.max_time, duration)
+            if failed:
+                stats.errors += 1
+
+        if duration > self.cfg["slow_threshold"]:
+            self.app.log("Slow expression took {:.0f} ms: {}",
+                         duration * 1000, stats.label,
+                         level="WARNING")
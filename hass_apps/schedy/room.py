@@ -10,14 +10,24 @@ if T.TYPE_CHECKING:
     from .app import SchedyApp
     from .actor.base import ActorBase
 
+import array
 import datetime
 import functools
 import threading
+import time
 
 from .. import common
-from . import expression, schedule, util
+from . import compiler, expression, schedule, util
 
 
+# a frame of the worklist of Room.eval_schedule(): the rules to check at
+# one nesting level, an iterator over those left with their positions and
+# the path leading to them
+EvalFrame = T.Tuple[
+    T.Tuple[schedule.Rule, ...], T.Iterator[T.Tuple[int, schedule.Rule]],
+    T.Optional[schedule.RulePathNode],
+]
+
 def sync_proxy(handler: T.Callable) -> T.Callable:
     """A decorator for wrapping event and state handlers.
     It can be applied to members of Room or of objects having a Room
@@ -58,6 +68,12 @@ class Room:
 
     # pylint: disable=too-many-instance-attributes
 
+    # interval at which forecasts evaluate schedules with expressions
+    # whose results may depend on the time they're evaluated for
+    FORECAST_STEP = datetime.timedelta(minutes=15)
+    # names that make an expression's result depend on the time
+    TIME_DEPENDENT_NAMES = frozenset(("app", "date", "datetime", "now", "time"))
+
     def __init__(self, name: str, cfg: dict, app: "SchedyApp") -> None:
         self.name = name
         self.cfg = cfg
@@ -70,6 +86,7 @@ class Room:
         self._scheduled_value = None  # type: T.Any
         self._rescheduling_time = None  # type: T.Optional[datetime.datetime]
         self._rescheduling_timer = None  # type: T.Optional[uuid.UUID]
+        self._scheduling_time = None  # type: T.Optional[datetime.datetime]
         self._overlaid_wanted_value = None  # type: T.Any
         self._overlaid_scheduled_value = None  # type: T.Any
         self._overlaid_rescheduling_time = None  # type: T.Optional[datetime.datetime]
@@ -85,6 +102,30 @@ class Room:
     def __str__(self) -> str:
         return "R:{}".format(self.cfg.get("friendly_name", self.name))
 
+    def _arm_scheduling_timer(self) -> None:
+        """Registers the room with the app's timer wheel for the next
+        moment at which the set of active rules in the room's schedule
+        changes. The registration is renewed by notify_scheduling_time()
+        when that moment has come."""
+
+        assert self.schedule is not None
+
+        now = self.app.datetime()
+        if self._scheduling_time is not None and self._scheduling_time > now:
+            # timer fired a little early, don't arm it for the same time
+            now = self._scheduling_time
+
+        self._scheduling_time = self.schedule.get_next_transition(now)
+        if self._scheduling_time is None:
+            self.app.timer_wheel.unregister(self)
+            self.log("Schedule never changes, no scheduling timer needed.",
+                     level="DEBUG")
+            return
+
+        self.log("Next scheduling timer at {}.", self._scheduling_time,
+                 level="DEBUG")
+        self.app.timer_wheel.register(self, self._scheduling_time)
+
     def _clear_overlay(self) -> None:
         """Removes all stored overlay state."""
 
@@ -142,11 +183,10 @@ class Room:
             return datetime.datetime.fromtimestamp(value)
 
         entity_id = "schedy.{}_{}".format(self.app.name, self.name)
-        self.log("Loading state of {} from Home Assistant."
-                 .format(repr(entity_id)),
+        self.log("Loading state of {!r} from Home Assistant.", entity_id,
                  level="DEBUG", prefix=common.LOG_PREFIX_OUTGOING)
         state = self.app.get_state(entity_id, attribute="all")
-        self.log("  = {}".format(repr(state)),
+        self.log("  = {!r}", state,
                  level="DEBUG", prefix=common.LOG_PREFIX_INCOMING)
 
         if isinstance(state, dict):
@@ -187,14 +227,6 @@ class Room:
         self._rescheduling_time, self._rescheduling_timer = None, None
         self.apply_schedule(reset=True)
 
-    @sync_proxy
-    def _scheduling_timer_cb(self, kwargs: dict) -> None:
-        """Is called whenever a scheduling timer fires."""
-
-        self.log("Scheduling timer fired.",
-                 level="DEBUG")
-        self.apply_schedule()
-
     def _store_for_overlaying(self, scheduled_value: T.Any) -> bool:
         """This method is called before a value overlay is put into place.
         When a re-scheduling timer is running or the scheduled and
@@ -260,15 +292,14 @@ class Room:
         }
 
         unchanged = (state, attrs) == self._last_state
-        self.log("{} HA state: state={}, attributes={}"
-                 .format("Unchanged" if unchanged else "Sending new",
-                         repr(state), attrs),
+        self.log("{} HA state: state={!r}, attributes={}",
+                 "Unchanged" if unchanged else "Sending new", state, attrs,
                  level="DEBUG")
         if unchanged:
             return
 
         entity_id = "schedy.{}_{}".format(self.app.name, self.name)
-        self.app.set_state(entity_id, state=state, attributes=attrs)
+        self.app.state_publisher.publish(entity_id, state, attrs)
         self._last_state = (state, attrs)
 
     def _validate_value(self, value: T.Any) -> T.Any:
@@ -297,15 +328,22 @@ class Room:
         checks can be skipped by setting reset to True.
         force_resend is passed through to set_value()."""
 
-        self.log("Applying room's schedule (reset={}, force_resend={})."
-                 .format(reset, force_resend),
+        self.log("Applying room's schedule (reset={}, force_resend={}).",
+                 reset, force_resend,
                  level="DEBUG")
 
         assert self.app.actor_type is not None
 
         result = None
         if self.schedule:
-            result = self.eval_schedule(self.schedule, self.app.datetime())
+            with expression.SchedulingPass(self.app) as scheduling_pass, \
+                 expression.EntityRecorder() as recorder:
+                result = self.eval_schedule(
+                    self.schedule, scheduling_pass.now
+                )
+            if self.app.cfg["reevaluate_on_state_change"] or \
+               self.app.cfg["share_expression_results"]:
+                self.app.entity_watcher.update(self, recorder.entity_ids)
         if result is None:
             self.log("No suitable value found in schedule.",
                      level="DEBUG")
@@ -367,107 +405,156 @@ class Room:
         return True
 
     def eval_expr(
-            self, expr: types.CodeType
+            self, expr: types.CodeType,
+            when: T.Optional[datetime.datetime] = None,
+            path: T.Optional[schedule.RulePathNode] = None,
+            share_results: bool = True,
     ) -> T.Any:
         """This is a wrapper around expression.eval_expr that adds
-        the room_name to the evaluation environment, as well as all
-        configured expression_modules. It also catches any exception
-        raised during evaluation. In this case, the caught Exception
-        object is returned."""
+        the room_name to the evaluation environment. It also catches
+        any exception raised during evaluation. In this case, the caught
+        Exception object is returned. when is the time to evaluate the
+        expression for, it defaults to the current time. path is the
+        rule path the expression was found at, which the expression
+        profiler files the execution under.
+        If share_expression_results is enabled, when is given and
+        share_results is True, results are shared with other rooms
+        through the app's expression cache."""
+
+        cache = self.app.expression_cache
+        if share_results and when is not None and \
+           self.app.cfg["share_expression_results"] and \
+           cache.is_shareable(expr):
+            hit, result = cache.get(expr, when)
+            if hit:
+                return result
+            with expression.EntityRecorder() as recorder:
+                result = self._eval_expr(expr, when, path)
+            cache.put(expr, when, result, recorder.entity_ids)
+            return result
 
-        extra_env = {
-            "room_name": self.name,
-        }
-        assert self.app.actor_type is not None
-        self.app.actor_type.prepare_eval_environment(extra_env)
+        return self._eval_expr(expr, when, path)
 
+    def _eval_expr(
+            self, expr: types.CodeType,
+            when: T.Optional[datetime.datetime] = None,
+            path: T.Optional[schedule.RulePathNode] = None,
+    ) -> T.Any:
+        """Evaluates the given expression without consulting the app's
+        expression cache. See eval_expr()."""
+
+        profiler = self.app.expression_profiler
+        if profiler is not None:
+            start = time.perf_counter()
+
+        node = None if path is None else path.find_expr_node(expr)
         try:
-            return expression.eval_expr(expr, self.app, extra_env=extra_env)
+            result = expression.eval_expr(
+                expr, self.app, when=when, room_name=self.name,
+                rule=None if node is None else node.rule,
+            )
         except Exception as err:  # pylint: disable=broad-except
             self.log("Error while evaluating expression: {}".format(repr(err)),
                      level="ERROR")
-            return err
+            result = err
+
+        if profiler is not None:
+            profiler.record(
+                expr, time.perf_counter() - start,
+                isinstance(result, Exception), self, path
+            )
+        return result
 
     def eval_schedule(  # pylint: disable=too-many-branches,too-many-locals
-            self, sched: schedule.Schedule, when: datetime.datetime
+            self, sched: schedule.Schedule, when: datetime.datetime,
+            share_results: bool = True,
     ) -> T.Optional[T.Tuple[T.Any, T.Set[str], schedule.Rule]]:
         """Evaluates a schedule, computing the value for the time the
         given datetime object represents. The resulting value, a set of
         markers applied to the value and the matched rule are returned.
         If no value could be found in the schedule (e.g. all rules
-        evaluate to Skip()), None is returned."""
-
-        def insert_paths(
-                paths: T.List[schedule.RulePath], first_index: int,
-                path_prefix: schedule.RulePath,
-                rules: T.Iterable[schedule.Rule]
-        ) -> None:
-            """Helper to append each single of a set of rules to a commmon
-            path prefix and insert the resulting paths into a list."""
-
-            for rule in rules:
-                path = path_prefix.copy()
-                path.add(rule)
-                paths.insert(first_index, path)
-                first_index += 1
+        evaluate to Skip()), None is returned.
+        share_results is passed on to eval_expr()."""
 
         def log(
-                msg: str, path: schedule.RulePath,
+                msg: str, path: schedule.RulePathNode,
                 *args: T.Any, **kwargs: T.Any
         ) -> None:
             """Wrapper around self.log that prefixes spaces to the
-            message based on the length of the rule path."""
+            message based on the length of the rule path. Nothing is
+            formatted when the level isn't enabled."""
 
-            prefix = " " * 3 * max(0, len(path.rules) - 1) + "\u251c\u2500"
-            self.log("{} {}".format(prefix, msg), *args, **kwargs)
+            if not self.app.is_log_level_enabled(kwargs.get("level", "INFO")):
+                return
+            prefix = " " * 3 * max(0, path.depth - 1) + "\u251c\u2500"
+            self.log("{} {}", prefix, common.LogMessage(msg, args), **kwargs)
 
-        self.log("Assuming it to be {}.".format(when),
+        self.log("Assuming it to be {}.", when,
                  level="DEBUG")
 
-        rules = list(sched.get_matching_rules(when))
-        self.log("{} / {} rules of {} are currently valid."
-                 .format(len(rules), len(sched.rules), sched),
+        if self.app.cfg["compile_schedules"]:
+            return compiler.compile_schedule(sched).evaluate(
+                self, when, share_results
+            )
+
+        rules = sched.get_matching_rules(when)
+        self.log("{} / {} rules of {} are currently valid.",
+                 len(rules), len(sched.rules), sched,
                  level="DEBUG")
 
+        actor_type = self.app.actor_type
         expr_cache = {}  # type: T.Dict[types.CodeType, T.Any]
         markers = set()
         pre_results = []
-        paths = []  # type: T.List[schedule.RulePath]
-        insert_paths(paths, 0, schedule.RulePath(sched), rules)
-        path_idx = 0
-        while path_idx < len(paths):
-            path = paths[path_idx]
-            path_idx += 1
+        # The worklist is a stack with one frame per nesting level, each
+        # holding the rules left to check at that level and the path
+        # leading to them. A Break() just drops the frames of the levels
+        # it skips.
+        frames = [
+            (rules, enumerate(rules), None)
+        ]  # type: T.List[EvalFrame]
+        while frames:
+            siblings, remaining, parent = frames[-1]
+            pos, rule = next(remaining, (-1, None))
+            if rule is None:
+                frames.pop()
+                continue
+            path = schedule.RulePathNode(sched, parent, rule, siblings, pos)
 
-            log("{}".format(path), path, level="DEBUG")
+            log("{}", path, path, level="DEBUG")
 
-            last_rule = path.rules[-1]
+            last_rule = rule
             if isinstance(last_rule, schedule.SubScheduleRule):
-                _rules = list(last_rule.sub_schedule.get_matching_rules(when))
-                log("{} / {} rules of {} are currently valid."
-                    .format(len(_rules), len(last_rule.sub_schedule.rules),
-                            last_rule.sub_schedule),
-                    path, level="DEBUG")
-                insert_paths(paths, path_idx, path, _rules)
+                _rules = last_rule.sub_schedule.get_matching_rules(when)
+                log("{} / {} rules of {} are currently valid.", path,
+                    len(_rules), len(last_rule.sub_schedule.rules),
+                    last_rule.sub_schedule, level="DEBUG")
+                frames.append((_rules, enumerate(_rules), path))
                 continue
 
             result = None
-            rules_with_expr_or_value = path.rules_with_expr_or_value
-            for rule in reversed(rules_with_expr_or_value):
-                if rule.expr is not None:
+            validated = False
+            has_expr_or_value = path.expr_node is not None
+            for rule in path.iter_rules_with_expr_or_value():
+                if actor_type in rule.folded_results:
+                    result = rule.folded_results[actor_type]
+                    validated = True
+                    log("=> {!r}  [folded]", path, result, level="DEBUG")
+                elif rule.expr is not None:
                     if rule.expr in expr_cache:
                         result = expr_cache[rule.expr]
-                        log("=> {}  [cache-hit]".format(repr(result)),
-                            path, level="DEBUG")
+                        log("=> {!r}  [cache-hit]", path, result,
+                            level="DEBUG")
                     else:
-                        result = self.eval_expr(rule.expr)
+                        expression.EntityRecorder.record(rule.entity_ids)
+                        result = self.eval_expr(
+                            rule.expr, when, path, share_results
+                        )
                         expr_cache[rule.expr] = result
-                        log("=> {}".format(repr(result)),
-                            path, level="DEBUG")
+                        log("=> {!r}", path, result, level="DEBUG")
                 elif rule.value is not None:
                     result = rule.value
-                    log("=> {}".format(repr(result)),
-                        path, level="DEBUG")
+                    log("=> {!r}", path, result, level="DEBUG")
                 if result is not None:
                     break
 
@@ -476,7 +563,7 @@ class Room:
                 result = result.result
 
             if result is None:
-                if rules_with_expr_or_value:
+                if has_expr_or_value:
                     log("All expressions returned None, skipping rule.",
                         path, level="WARNING")
                 else:
@@ -488,24 +575,20 @@ class Room:
             elif isinstance(result, expression.Abort):
                 break
             elif isinstance(result, expression.Break):
-                prefix_size = max(0, len(path.rules) - result.levels)
-                prefix = path.rules[:prefix_size]
-                while path_idx < len(paths) and \
-                      paths[path_idx].root_schedule == path.root_schedule and \
-                      paths[path_idx].rules[:prefix_size] == prefix:
-                    del paths[path_idx]
+                del frames[max(0, path.depth - result.levels):]
             elif isinstance(result, expression.IncludeSchedule):
-                _rules = list(result.schedule.get_matching_rules(when))
-                log("{} / {} rules of {} are currently valid."
-                    .format(len(_rules), len(result.schedule.rules),
-                            result.schedule),
-                    path, level="DEBUG")
-                _path = path.copy()
-                del _path.rules[-1]
-                _path.add(schedule.SubScheduleRule(result.schedule))
-                insert_paths(paths, path_idx, _path, _rules)
+                _rules = result.schedule.get_matching_rules(when)
+                log("{} / {} rules of {} are currently valid.", path,
+                    len(_rules), len(result.schedule.rules),
+                    result.schedule, level="DEBUG")
+                _path = schedule.RulePathNode(
+                    sched, path.parent,
+                    schedule.SubScheduleRule(result.schedule)
+                )
+                frames.append((_rules, enumerate(_rules), _path))
             elif isinstance(result, expression.PreliminaryResult):
-                if isinstance(result, expression.PreliminaryValidationMixin):
+                if isinstance(result, expression.PreliminaryValidationMixin) \
+                   and not validated:
                     value = self._validate_value(result.value)
                     if value is None:
                         self.log("Aborting scheduling",
@@ -516,12 +599,12 @@ class Room:
             elif isinstance(result, expression.Skip):
                 continue
             else:
-                result = self._validate_value(result)
+                if not validated:
+                    result = self._validate_value(result)
                 for pre_result in pre_results:
                     if result is None:
                         break
-                    log("+ {}".format(repr(pre_result)),
-                        path, level="DEBUG")
+                    log("+ {!r}", path, pre_result, level="DEBUG")
                     try:
                         result = pre_result.combine_with(result)
                     except expression.PreliminaryCombiningError as err:
@@ -530,20 +613,88 @@ class Room:
                                  level="ERROR")
                         result = None
                         break
-                    log("= {}".format(repr(result)),
-                        path, level="DEBUG")
+                    log("= {!r}", path, result, level="DEBUG")
                     result = self._validate_value(result)
                 if result is None:
                     self.log("Aborting scheduling",
                              level="ERROR")
                     break
-                self.log("Final result: {}".format(repr(result)),
+                self.log("Final result: {!r}", result,
                          level="DEBUG")
                 return result, markers, last_rule
 
         self.log("Found no result.", level="DEBUG")
         return None
 
+    def forecast(
+            self, start: datetime.datetime, end: datetime.datetime
+    ) -> T.Tuple[array.array, T.List[T.Any]]:
+        """Forecasts the values the room's schedule will produce between
+        start and end. Instead of evaluating every minute, the schedule
+        is only evaluated at start and at the moments where the set of
+        active rules of the room's schedule or of one of the
+        schedule_snippets, which may be included by expressions, changes.
+        If one of these schedules contains an expression that may depend
+        on the time, it's additionally evaluated every FORECAST_STEP.
+        Expressions see the time they are evaluated for, but the
+        current states of entities. Their results aren't shared with
+        other rooms, so that the results cached for the current
+        scheduling pass are kept.
+        Returns an array of timestamps and a list with the value
+        starting at each of them, None meaning that no value was found.
+        Consecutive equal values are merged."""
+
+        assert self.app.actor_type is not None
+
+        timestamps = array.array("d")
+        values = []  # type: T.List[T.Any]
+        if not self.schedule:
+            return timestamps, values
+
+        schedules = [self.schedule]
+        schedules.extend(self.app.cfg["schedule_snippets"].values())
+        step = None
+        if any(self._is_time_dependent(sched) for sched in schedules):
+            step = self.FORECAST_STEP
+
+        when = start  # type: T.Optional[datetime.datetime]
+        while when is not None and when < end:
+            result = self.eval_schedule(
+                self.schedule, when, share_results=False
+            )
+            value = None if result is None else result[0]
+            if not values or \
+               (value is None) != (values[-1] is None) or \
+               value is not None and \
+               not self.app.actor_type.values_equal(value, values[-1]):
+                timestamps.append(when.timestamp())
+                values.append(value)
+
+            transitions = [
+                transition for transition in (
+                    sched.get_next_transition(when) for sched in schedules
+                ) if transition is not None
+            ]
+            if step is not None:
+                transitions.append(when + step)
+            when = min(transitions) if transitions else None
+
+        return timestamps, values
+
+    def _is_time_dependent(self, sched: schedule.Schedule) -> bool:
+        """Tells whether the given schedule or one of its sub-schedules
+        contains an expression, not folded at config time, that uses
+        one of the TIME_DEPENDENT_NAMES."""
+
+        actor_type = self.app.actor_type
+        for entry in sched.get_path_table():
+            rule = entry.rule
+            if rule.expr is not None and \
+               actor_type not in rule.folded_results and \
+               util.get_code_names(rule.expr) & self.TIME_DEPENDENT_NAMES:
+                return True
+        return False
+
     @sync_proxy
     def initialize(self, reset: bool = False) -> None:
         """Should be called after all schedules and actors have been
@@ -559,12 +710,7 @@ class Room:
             self._initialize_actor_cb({"actor": actor})
 
         if self.schedule:
-            times = self.schedule.get_scheduling_times()
-            self.log("Registering scheduling timers at: {{{}}}"
-                     .format(", ".join([str(_time) for _time in times])),
-                     level="DEBUG")
-            for _time in times:
-                self.app.run_daily(self._scheduling_timer_cb, _time)
+            self._arm_scheduling_timer()
         else:
             self.log("No schedule configured.", level="DEBUG")
 
@@ -573,11 +719,10 @@ class Room:
         else:
             self._restore_state()
 
-    def log(self, msg: str, *args: T.Any, **kwargs: T.Any) -> None:
+    def log(self, msg: T.Any, *args: T.Any, **kwargs: T.Any) -> None:
         """Prefixes the room to log messages."""
 
-        msg = "[{}] {}".format(self, msg)
-        self.app.log(msg, *args, **kwargs)
+        self.app.log("[{}] {}", self, common.LogMessage(msg, args), **kwargs)
 
     def notify_set_value_event(
             self, expr_raw: str = None, value: T.Any = None,
@@ -630,6 +775,16 @@ class Room:
         elif self.cfg["rescheduling_delay"] and not was_wanted:
             self.start_rescheduling_timer()
 
+    @sync_proxy
+    def notify_scheduling_time(self) -> None:
+        """Is called by the app's timer wheel when the moment registered
+        by this room has come."""
+
+        self.log("Scheduling timer fired.",
+                 level="DEBUG")
+        self._arm_scheduling_timer()
+        self.apply_schedule()
+
     def set_value(
             self, value: T.Any, scheduled: bool = False,
             force_resend: bool = False
@@ -638,10 +793,9 @@ class Room:
         Values won't be send to actors redundantly unless force_resend
         is True."""
 
-        self.log("Setting value to {}.  [{}{}]"
-                 .format(repr(value),
-                         "scheduled" if scheduled else "manual",
-                         ", force re-sending" if force_resend else ""),
+        self.log("Setting value to {!r}.  [{}{}]", value,
+                 "scheduled" if scheduled else "manual",
+                 ", force re-sending" if force_resend else "",
                  level="DEBUG")
 
         self._wanted_value = value
@@ -649,7 +803,7 @@ class Room:
         changed = False
         for actor in self.actors:
             if not actor.is_initialized:
-                self.log("Skipping uninitialized {}.".format(repr(actor)),
+                self.log("Skipping uninitialized {!r}.", actor,
                          level="DEBUG")
                 continue
 
@@ -700,7 +854,12 @@ class Room:
             )
             value = None
             if isinstance(result, expression.IncludeSchedule):
-                _result = self.eval_schedule(result.schedule, self.app.datetime())
+                # evaluated for the current instant, which the results
+                # shared between rooms aren't meant for
+                _result = self.eval_schedule(
+                    result.schedule, self.app.datetime(),
+                    share_results=False,
+                )
                 if _result is not None:
                     value = _result[0]
                     markers.update(_result[1])
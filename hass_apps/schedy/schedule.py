@@ -2,23 +2,44 @@
 This module implements the Schedule and Rule classes.
 """
 
+import types
 import typing as T
-if T.TYPE_CHECKING:
-    # pylint: disable=cyclic-import,unused-import
-    import types
 
+import bisect
+import collections
 import datetime
+import itertools
+import threading
+import weakref
 
 from . import util
 
 
 class Rule:
-    """A rule that can be added to a schedule."""
+    """A rule that can be added to a schedule.
+    Rules are immutable. Identical rules can be shared by interning
+    them with Rule.interned().
+    folded_results maps actor types to the already validated result of
+    the rule's constant expression or value, as computed at config
+    time.
+    entity_ids contains the ids of entities the expression is known to
+    read, as found by util.extract_entity_ids()."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    __slots__ = ("name", "start_time", "end_time", "end_plus_days",
+                 "constraints", "expr", "expr_raw", "value",
+                 "folded_results", "entity_ids", "_check_constraints",
+                 "_frozen", "__weakref__")
 
     # names of schedule rule constraints to be fetched from a rule definition
     CONSTRAINTS = ("years", "months", "days", "weeks", "weekdays",
                    "start_date", "end_date")
 
+    # table of interned rules, keyed by the result of _get_intern_key()
+    _interned = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary
+    _interned_lock = threading.Lock()
+
     def __init__(
             self, name: str = None,
             start_time: datetime.time = None, end_time: datetime.time = None,
@@ -29,24 +50,22 @@ class Rule:
         if expr_raw is not None and value is not None:
             raise ValueError("specify only one of expr_raw and value, not both")
 
-        self.name = name
-
         midnight = datetime.time(0, 0)
         if start_time is None:
             start_time = midnight
-        self.start_time = start_time
-
         if end_time is None:
             end_time = midnight
-        self.end_time = end_time
-
         if end_plus_days is None:
             end_plus_days = 1 if end_time <= start_time else 0
-        self.end_plus_days = end_plus_days
 
-        if constraints is None:
-            constraints = {}
-        self.constraints = constraints
+        self.name = name  # type: T.Optional[str]
+        self.start_time = start_time  # type: datetime.time
+        self.end_time = end_time  # type: datetime.time
+        self.end_plus_days = end_plus_days  # type: int
+        self.constraints = types.MappingProxyType(
+            dict(constraints or {})
+        )  # type: T.Mapping[str, T.Any]
+        self._check_constraints = self._compile_constraints()
 
         # try to simplify the rule
         if self.is_always_valid:
@@ -55,13 +74,52 @@ class Rule:
             self.end_plus_days = 1
 
         self.expr = None  # type: T.Optional[types.CodeType]
-        self.expr_raw = None  # type: T.Optional[str]
+        self.entity_ids = frozenset()  # type: T.FrozenSet[str]
         if expr_raw is not None:
             expr_raw = expr_raw.strip()
-            self.expr_raw = expr_raw
             self.expr = util.compile_expression(expr_raw)
+            self.entity_ids = util.extract_entity_ids(expr_raw)
+        self.expr_raw = expr_raw  # type: T.Optional[str]
+        self.value = value  # type: T.Any
+        self.folded_results = {}  # type: T.Dict[T.Any, T.Any]
+        self._frozen = True
+
+    def __setattr__(self, name: str, value: T.Any) -> None:
+        # attributes can only be set during __init__()
+        if getattr(self, "_frozen", False):
+            raise AttributeError(
+                "{} objects are immutable".format(type(self).__name__)
+            )
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("{} objects are immutable".format(type(self).__name__))
 
-        self.value = value
+    def _get_intern_key(self) -> T.Hashable:
+        """Returns a key identifying rules that are interchangeable.
+        A TypeError is raised if the rule contains unhashable data."""
+
+        return (
+            type(self), self.name, self.start_time, self.end_time,
+            self.end_plus_days, util.freeze_value(dict(self.constraints)),
+            self.expr_raw, util.freeze_value(self.value),
+        )
+
+    @classmethod
+    def interned(cls, *args: T.Any, **kwargs: T.Any) -> "Rule":
+        """Creates a rule with the given arguments and returns it, unless
+        an identical rule already exists, which is returned instead.
+        Rules with unhashable values are never shared."""
+
+        rule = cls(*args, **kwargs)
+        try:
+            key = rule._get_intern_key()
+        except TypeError:
+            return rule
+
+        with cls._interned_lock:
+            shared = cls._interned.setdefault(key, rule)  # type: Rule
+        return shared
 
     def __repr__(self) -> str:
         return "<Rule {}{}>".format(
@@ -100,31 +158,99 @@ class Rule:
 
         return tokens
 
+    @staticmethod
+    def _compile_date_constraint(
+            constraint: T.Dict[str, int], direction: int
+    ) -> T.Callable[[datetime.date], bool]:
+        """Returns a predicate checking a date against a start_date
+        (direction > 0) or end_date (direction < 0) constraint.
+        Fully specified dates are compared by ordinal. Partial dates are
+        compared as (year, month, day) tuples, with missing fields taken
+        from the checked date. As there is no valid date between an
+        invalid one like 2017-02-30 and its next/previous valid date,
+        this gives the same result as repairing it first."""
+
+        if all(field in constraint for field in ("year", "month", "day")):
+            bound = util.build_date_from_constraint(
+                constraint, datetime.date.today(), direction
+            ).toordinal()
+            if direction > 0:
+                return lambda date: date.toordinal() >= bound
+            return lambda date: date.toordinal() <= bound
+
+        year = constraint.get("year")
+        month = constraint.get("month")
+        day = constraint.get("day")
+
+        def get_bound(date: datetime.date) -> T.Tuple[int, int, int]:
+            """Builds the possibly invalid bound as tuple."""
+
+            return (date.year if year is None else year,
+                    date.month if month is None else month,
+                    date.day if day is None else day)
+
+        if direction > 0:
+            return lambda date: \
+                (date.year, date.month, date.day) >= get_bound(date)
+        return lambda date: \
+            (date.year, date.month, date.day) <= get_bound(date)
+
+    def _compile_constraints(self) -> T.Callable[[datetime.date], bool]:
+        """Compiles the constraints of this rule into a single predicate
+        telling whether they are fulfilled for a given date. Sets of
+        months, days, weeks and weekdays are turned into bitmasks and
+        date constraints into precomputed bounds. Cheap checks are
+        ordered first."""
+
+        checks = []  # type: T.List[T.Callable[[datetime.date], T.Any]]
+        constraints = self.constraints
+
+        if "months" in constraints:
+            months = util.build_bitmask(constraints["months"])
+            checks.append(lambda date: months >> date.month & 1)
+        if "days" in constraints:
+            days = util.build_bitmask(constraints["days"])
+            checks.append(lambda date: days >> date.day & 1)
+        if "weekdays" in constraints:
+            weekdays = util.build_bitmask(constraints["weekdays"])
+            checks.append(lambda date: weekdays >> date.isoweekday() & 1)
+        if "weeks" in constraints:
+            weeks = util.build_bitmask(constraints["weeks"])
+            checks.append(lambda date: weeks >> date.isocalendar()[1] & 1)
+        if "years" in constraints:
+            years = frozenset(constraints["years"])
+            checks.append(lambda date: date.isocalendar()[0] in years)
+        if "start_date" in constraints:
+            checks.append(self._compile_date_constraint(
+                constraints["start_date"], 1
+            ))
+        if "end_date" in constraints:
+            checks.append(self._compile_date_constraint(
+                constraints["end_date"], -1
+            ))
+
+        if not checks:
+            return lambda date: True
+        if len(checks) == 1:
+            check = checks[0]
+            return lambda date: bool(check(date))
+
+        _checks = tuple(checks)
+        def check_all(date: datetime.date) -> bool:
+            """Checks all compiled constraints."""
+
+            for check in _checks:
+                if not check(date):
+                    return False
+            return True
+
+        return check_all
+
     def check_constraints(self, date: datetime.date) -> bool:
         """Checks all constraints of this rule against the given date
         and returns whether they are fulfilled"""
 
-        # pylint: disable=too-many-return-statements
-
-        year, week, weekday = date.isocalendar()
-        for constraint, allowed in self.constraints.items():
-            if constraint == "years" and year not in allowed:
-                return False
-            if constraint == "months" and date.month not in allowed:
-                return False
-            if constraint == "days" and date.day not in allowed:
-                return False
-            if constraint == "weeks" and week not in allowed:
-                return False
-            if constraint == "weekdays" and weekday not in allowed:
-                return False
-            if constraint == "start_date" and \
-               date < util.build_date_from_constraint(allowed, date, 1):
-                return False
-            if constraint == "end_date" and \
-               date > util.build_date_from_constraint(allowed, date, -1):
-                return False
-        return True
+        return self._check_constraints(date)
 
     @property
     def is_always_valid(self) -> bool:
@@ -138,6 +264,21 @@ class Rule:
         return self.end_plus_days >= 1
 
 
+# An entry of a schedule's path table. parent is the table index of the
+# entry for the SubScheduleRule this rule belongs to or -1 for rules of
+# the root schedule, index is the position of rule in its schedule.
+# has_expr_or_value tells whether any rule along the path has an
+# expression or value.
+PathTableEntry = collections.namedtuple(
+    "PathTableEntry", ("parent", "index", "rule", "depth", "has_expr_or_value")
+)
+# A cached path table with what it has been built from: the schedule's
+# version, its sub-schedules and their path tables.
+PathTableCache = T.Tuple[
+    T.Any, T.Tuple["Schedule", ...], T.Tuple, T.Tuple[PathTableEntry, ...]
+]
+
+
 class RulePath:
     """A chain of rules starting from a root schedule through sub-schedule
     rules."""
@@ -145,6 +286,9 @@ class RulePath:
     def __init__(self, root_schedule: "Schedule") -> None:
         self.root_schedule = root_schedule
         self.rules = []  # type: T.List[Rule]
+        # positions of the rules in the rules lists of their schedules,
+        # None where not known
+        self.indexes = []  # type: T.List[T.Optional[int]]
 
     def __repr__(self) -> str:
         if not self.rules:
@@ -152,8 +296,10 @@ class RulePath:
 
         locs = []
         sched = self.root_schedule
-        for rule in self.rules:
-            if rule in sched.rules:
+        for rule, index in zip(self.rules, self.indexes):
+            if index is not None:
+                loc = str(index + 1)
+            elif rule in sched.rules:
                 loc = str(sched.rules.index(rule) + 1)
             else:
                 loc = "?"
@@ -164,8 +310,10 @@ class RulePath:
 
         return "<{}/{}:{}>".format(self.root_schedule, "/".join(locs), rule)  # pylint: disable=undefined-loop-variable
 
-    def add(self, rule: Rule) -> None:
-        """Add's a rule to the end of the path.
+    def add(self, rule: Rule, index: T.Optional[int] = None) -> None:
+        """Add's a rule to the end of the path. index may be given as
+        the rule's position in the rules list of its schedule, which is
+        needed to locate rules that occur multiple times in that list.
         A ValueError is raised when the previous rule is a final rule."""
 
         if self.rules and not isinstance(self.rules[-1], SubScheduleRule):
@@ -174,13 +322,14 @@ class RulePath:
                 .format(self.rules[-1])
             )
         self.rules.append(rule)
+        self.indexes.append(index)
 
     def copy(self) -> "RulePath":
         """Creates a mutable copy of this path and returns it."""
 
         path = type(self)(self.root_schedule)
-        for rule in self.rules:
-            path.add(rule)
+        for rule, index in zip(self.rules, self.indexes):
+            path.add(rule, index)
         return path
 
     @property
@@ -201,17 +350,131 @@ class RulePath:
         ))
 
 
+class RulePathNode:
+    """An immutable rule path, represented by its last rule and a
+    pointer to the node of the path without that rule. Paths sharing
+    a prefix share the nodes of that prefix, hence extending a path
+    doesn't copy it.
+    expr_node is the nearest node along the path, starting with this one,
+    whose rule has an expression or value, or None if there is none.
+    siblings and pos optionally tell where the rule was taken from,
+    namely siblings[pos], siblings being rules of its schedule in the
+    order of its rules list. This is used by get_index()."""
+
+    __slots__ = (
+        "root_schedule", "parent", "rule", "depth", "expr_node",
+        "siblings", "pos",
+    )
+
+    def __init__(
+            self, root_schedule: "Schedule",
+            parent: T.Optional["RulePathNode"], rule: Rule,
+            siblings: T.Sequence[Rule] = None, pos: int = None,
+    ) -> None:
+        self.root_schedule = root_schedule
+        self.parent = parent
+        self.rule = rule
+        self.siblings = siblings
+        self.pos = pos
+        if rule.expr is not None or rule.value is not None:
+            self.expr_node = self  # type: T.Optional[RulePathNode]
+        elif parent is not None:
+            self.expr_node = parent.expr_node
+        else:
+            self.expr_node = None
+        self.depth = 1 if parent is None else parent.depth + 1  # type: int
+
+    def __repr__(self) -> str:
+        return repr(self.to_rule_path())
+
+    def iter_rules_with_expr_or_value(self) -> T.Iterator[Rule]:
+        """Yields the rules of the path containing an expression or value,
+        from right to left."""
+
+        node = self.expr_node
+        while node is not None:
+            yield node.rule
+            node = node.parent.expr_node if node.parent is not None else None
+
+    def find_expr_node(
+            self, expr: types.CodeType
+    ) -> T.Optional["RulePathNode"]:
+        """Returns the nearest node along the path, starting with this
+        one, whose rule has the given expression, or None if there is
+        none."""
+
+        node = self.expr_node
+        while node is not None and node.rule.expr is not expr:
+            node = node.parent.expr_node if node.parent is not None else None
+        return node
+
+    def get_index(self) -> T.Optional[int]:
+        """Returns the position of this node's rule in the rules list of
+        its schedule or None if it isn't known."""
+
+        if self.siblings is None or self.pos is None:
+            return None
+        if self.parent is None:
+            sched = self.root_schedule
+        elif isinstance(self.parent.rule, SubScheduleRule):
+            sched = self.parent.rule.sub_schedule
+        else:
+            return None
+
+        # identical rules may occur multiple times, hence count the
+        # occurrences before this one rather than searching for the rule
+        occurrence = sum(
+            1 for rule in self.siblings[:self.pos] if rule is self.rule
+        )
+        for index, rule in enumerate(sched.rules):
+            if rule is self.rule:
+                if not occurrence:
+                    return index
+                occurrence -= 1
+        return None
+
+    def get_rules(self) -> T.Tuple[Rule, ...]:
+        """Returns the rules of this path, from left to right."""
+
+        rules = []
+        node = self  # type: T.Optional[RulePathNode]
+        while node is not None:
+            rules.append(node.rule)
+            node = node.parent
+        return tuple(reversed(rules))
+
+    def to_rule_path(self) -> RulePath:
+        """Returns a RulePath with the rules of this path."""
+
+        nodes = []
+        node = self  # type: T.Optional[RulePathNode]
+        while node is not None:
+            nodes.append(node)
+            node = node.parent
+        path = RulePath(self.root_schedule)
+        for node in reversed(nodes):
+            path.add(node.rule, node.get_index())
+        return path
+
+
 class SubScheduleRule(Rule):
     """A schedule rule with a sub-schedule attached."""
 
+    __slots__ = ("sub_schedule",)
+
     def __init__(
             self, sub_schedule: "Schedule",
             *args: T.Any, **kwargs: T.Any
         ) -> None:
 
+        # has to be set before Rule.__init__() makes the rule immutable
+        self.sub_schedule = sub_schedule
         super().__init__(*args, **kwargs)
 
-        self.sub_schedule = sub_schedule
+    def _get_intern_key(self) -> T.Hashable:
+        """Only rules with the very same sub-schedule are shared."""
+
+        return (super()._get_intern_key(), id(self.sub_schedule))
 
     def _get_repr_tokens(self) -> T.List[str]:
         """Adds the sub-schedule information to repr()."""
@@ -221,67 +484,210 @@ class SubScheduleRule(Rule):
         return tokens
 
 
+class DayTimeline:
+    """The rules of a schedule that are active during the periods of a
+    single day. boundaries is a sorted list of times starting with
+    midnight, segments holds the tuple of active rules for the period
+    starting at the boundary with the same index."""
+
+    def __init__(
+            self, boundaries: T.List[datetime.time],
+            segments: T.List[T.Tuple[Rule, ...]],
+    ) -> None:
+        self.boundaries = boundaries
+        self.segments = segments
+
+    def __repr__(self) -> str:
+        return "<DayTimeline with {} segments>".format(len(self.segments))
+
+    def get_rules(self, _time: datetime.time) -> T.Tuple[Rule, ...]:
+        """Returns the rules active at the given time of day."""
+
+        return self.segments[bisect.bisect_right(self.boundaries, _time) - 1]
+
+
 class Schedule:
-    """Holds the schedule for a room with all its rules."""
+    """Holds the schedule for a room with all its rules.
+    The rules are kept as a tuple, so that they can't be changed
+    behind the back of the cached timelines and path tables. Assigning
+    new rules makes these be rebuilt."""
+
+    # number of dates for which day timelines are kept in the date index
+    DATE_INDEX_SIZE = 8
+    # number of days to look ahead when searching the next transition
+    TRANSITION_SEARCH_DAYS = 7
 
     def __init__(
             self, name: str = None, rules: T.Iterable[Rule] = None,
     ) -> None:
         self.name = name
-        self.rules = []  # type: T.List[Rule]
-        if rules is not None:
-            self.rules.extend(rules)
+        self._rules = tuple(rules or ())  # type: T.Tuple[Rule, ...]
+
+        self._version = 0
+        self._index_lock = threading.Lock()
+        self._index_version = None  # type: T.Any
+        self._date_index = collections.OrderedDict()  # type: collections.OrderedDict
+        self._path_table = None  # type: T.Optional[PathTableCache]
 
     def __add__(self, other: "Schedule") -> "Schedule":
-        if not isinstance(other, type(self)):
+        if not isinstance(other, Schedule):
             raise ValueError("{} objects may not be added to {}."
                              .format(type(other), self))
-        return Schedule(name=self.name, rules=self.rules + other.rules)
+        return CompositeSchedule(name=self.name, segments=(self, other))
 
     def __repr__(self) -> str:
         if self.name is None:
             return "<Schedule of {} rules>".format(len(self.rules))
         return "<Schedule {}>".format(repr(self.name))
 
+    @staticmethod
+    def _build_candidates(
+            rules: T.Iterable[Rule], date: datetime.date
+    ) -> T.Tuple[T.Tuple[Rule, int], ...]:
+        """Returns a tuple of (rule, days_back) pairs for all rules
+        that started on date or on one of the end_plus_days days before.
+        days_back is the number of days between date and the latest
+        date on which the rule's constraints are fulfilled."""
+
+        dates = []  # type: T.List[datetime.date]
+        candidates = []
+        for rule in rules:
+            while len(dates) <= rule.end_plus_days:
+                dates.append(date - datetime.timedelta(days=len(dates)))
+            for days_back in range(rule.end_plus_days + 1):
+                if rule.check_constraints(dates[days_back]):
+                    candidates.append((rule, days_back))
+                    break
+        return tuple(candidates)
+
+    def _build_timeline(
+            self, rules: T.Iterable[Rule], date: datetime.date
+    ) -> "DayTimeline":
+        """Builds the timeline of active rules for the given date."""
+
+        candidates = self._build_candidates(rules, date)
+        midnight = datetime.time(0, 0)
+        times = {midnight}
+        for rule, _ in candidates:
+            times.update((rule.start_time, rule.end_time))
+
+        # which rules are active can only change at start and end times
+        # of the candidates, hence checking at these times is sufficient
+        boundaries = []  # type: T.List[datetime.time]
+        segments = []  # type: T.List[T.Tuple[Rule, ...]]
+        for _time in sorted(times):
+            segment = tuple(
+                rule for rule, days_back in candidates
+                if self._check_time(rule, days_back, _time)
+            )
+            if segments and segment == segments[-1]:
+                continue
+            boundaries.append(_time)
+            segments.append(segment)
+
+        return DayTimeline(boundaries, segments)
+
+    def _get_rules(self) -> T.Tuple[Rule, ...]:
+        """Returns the current rules."""
+
+        return self._rules
+
+    def _get_timeline(self, date: datetime.date) -> "DayTimeline":
+        """Fetches the timeline for the given date from the date index,
+        building it if necessary. The index is cleared when the rules
+        have been invalidated and only the DATE_INDEX_SIZE most recently
+        used dates are kept."""
+
+        version = self._get_version()
+        with self._index_lock:
+            if version != self._index_version:
+                self._index_version = version
+                self._date_index.clear()
+
+            timeline = self._date_index.get(date)
+            if timeline is None:
+                timeline = self._build_timeline(self._get_rules(), date)
+                self._date_index[date] = timeline
+                while len(self._date_index) > self.DATE_INDEX_SIZE:
+                    self._date_index.popitem(last=False)
+            else:
+                self._date_index.move_to_end(date)
+
+        return timeline
+
+    @staticmethod
+    def _check_time(
+            rule: Rule, days_back: int, _time: datetime.time
+    ) -> bool:
+        """Tells whether a rule whose constraints were fulfilled days_back
+        days ago is active at the given time of day."""
+
+        for days in range(days_back, rule.end_plus_days + 1):
+            # on the start day, rule has to start not later than now
+            # (rule start <= _time)
+            if days == 0 and rule.start_time > _time:
+                # maybe there is a next day to try out
+                continue
+
+            # on the last day, rule is going to end today and that
+            # has to be later than now (rule end > _time)
+            if days == rule.end_plus_days and rule.end_time <= _time:
+                return False
+
+            return True
+
+        return False
+
+    @property
+    def rules(self) -> T.Tuple[Rule, ...]:
+        """The rules of this schedule."""
+
+        return self._get_rules()
+
+    @rules.setter
+    def rules(self, rules: T.Tuple[Rule, ...]) -> None:
+        self._rules = tuple(rules)
+        self._version += 1
+
+    def _get_version(self) -> T.Any:
+        """Returns a value that changes whenever new rules are assigned.
+        It tells cached timelines and path tables apart."""
+
+        return self._version
+
+    def _get_next_change(
+            self, after: datetime.datetime, days: int
+    ) -> T.Optional[datetime.datetime]:
+        """Returns the first moment after the given datetime at which
+        the set of rules active in this schedule (without descending into
+        sub-schedules) changes. None is returned if no change happens
+        within the given number of following days."""
+
+        date = after.date()
+        timeline = self._get_timeline(date)
+        idx = bisect.bisect_right(timeline.boundaries, after.time())
+        if idx < len(timeline.boundaries):
+            return datetime.datetime.combine(date, timeline.boundaries[idx])
+
+        current = timeline.segments[-1]
+        for _ in range(days):
+            date += datetime.timedelta(days=1)
+            timeline = self._get_timeline(date)
+            if timeline.segments[0] != current:
+                return datetime.datetime.combine(date, datetime.time(0, 0))
+            if len(timeline.boundaries) > 1:
+                return datetime.datetime.combine(date, timeline.boundaries[1])
+        return None
+
     def get_matching_rules(
             self, when: datetime.datetime
-        ) -> T.Iterator[Rule]:
-        """Returns an iterator over all rules of this schedule that are
+        ) -> T.Tuple[Rule, ...]:
+        """Returns a tuple of all rules of this schedule that are
         valid at the time represented by the given datetime object,
         keeping the order from the rules list. SubScheduleRule objects are
-        not expanded and yielded like normal rules."""
-
-        _time = when.time()
-        for rule in self.rules:
-            days_back = -1
-            found_start_day = False
-            while days_back < rule.end_plus_days:
-                days_back += 1
-                # starts with days=0 (meaning the current date)
-                _date = when.date() - datetime.timedelta(days=days_back)
-
-                found_start_day = found_start_day or \
-                                  rule.check_constraints(_date)
-                if not found_start_day:
-                    # try next day
-                    continue
-
-                # in first loop run, rule has to start today and not
-                # later than now (rule start <= when.time())
-                if days_back == 0 and rule.start_time > _time:
-                    # maybe there is a next day to try out
-                    continue
-
-                # in last loop run, rule is going to end today and that
-                # has to be later than now (rule end > when.time())
-                if days_back == rule.end_plus_days and \
-                   rule.end_time <= _time:
-                    # rule finally disqualified, continue with next rule
-                    break
+        not expanded and returned like normal rules."""
 
-                # rule matches!
-                yield rule
-                break
+        return self._get_timeline(when.date()).get_rules(when.time())
 
     def get_next_scheduling_datetime(
             self, now: datetime.datetime
@@ -315,15 +721,107 @@ class Schedule:
 
         return min(map(map_func, times))
 
+    def get_next_transition(
+            self, now: datetime.datetime
+    ) -> T.Optional[datetime.datetime]:
+        """Returns the next moment after now at which the set of active
+        rules of this schedule or one of its sub-schedules changes.
+        Unlike get_next_scheduling_datetime(), constraints are respected,
+        hence times of rules that won't be active are skipped.
+        If nothing changes within TRANSITION_SEARCH_DAYS days, midnight of
+        the day after is returned, so that the search can be resumed
+        from there. None is returned in case there are no rules in the
+        schedule which are not universally valid anyway."""
+
+        if not self.get_scheduling_times():
+            return None
+
+        schedules = {id(self): self}
+        for entry in self.get_path_table():
+            if isinstance(entry.rule, SubScheduleRule):
+                sched = entry.rule.sub_schedule
+                schedules.setdefault(id(sched), sched)
+
+        days = self.TRANSITION_SEARCH_DAYS
+        changes = [
+            change for change in (
+                sched._get_next_change(now, days)  # pylint: disable=protected-access
+                for sched in schedules.values()
+            ) if change is not None
+        ]
+        if changes:
+            return min(changes)
+        return datetime.datetime.combine(
+            now.date() + datetime.timedelta(days=days + 1),
+            datetime.time(0, 0)
+        )
+
+    def get_path_table(self) -> T.Tuple[PathTableEntry, ...]:
+        """Returns a flat table of all rule paths of this schedule,
+        including those into sub-schedules, in the order unfold() yields
+        them. The table is cached and only rebuilt when the rules of
+        this schedule or one of its sub-schedules have changed."""
+
+        version = self._get_version()
+        cached = self._path_table
+        if cached is not None and cached[0] == version:
+            sub_schedules = cached[1]
+            rules = None  # type: T.Optional[T.Tuple[Rule, ...]]
+        else:
+            rules = self._get_rules()
+            sub_schedules = tuple(
+                rule.sub_schedule for rule in rules
+                if isinstance(rule, SubScheduleRule)
+            )
+        sub_tables = tuple(sched.get_path_table() for sched in sub_schedules)
+        if rules is None:
+            assert cached is not None
+            if cached[2] == sub_tables:
+                return cached[3]
+            rules = self._get_rules()
+
+        entries = []  # type: T.List[PathTableEntry]
+        _sub_tables = iter(sub_tables)
+        for index, rule in enumerate(rules):
+            pos = len(entries)
+            has_expr_or_value = rule.expr is not None or rule.value is not None
+            entries.append(PathTableEntry(-1, index, rule, 0, has_expr_or_value))
+            if not isinstance(rule, SubScheduleRule):
+                continue
+            for entry in next(_sub_tables):
+                entries.append(PathTableEntry(
+                    pos if entry.parent < 0 else entry.parent + pos + 1,
+                    entry.index, entry.rule, entry.depth + 1,
+                    has_expr_or_value or entry.has_expr_or_value,
+                ))
+
+        table = tuple(entries)
+        self._path_table = (version, sub_schedules, sub_tables, table)
+        return table
+
+    def get_rule_path(self, table_index: int) -> RulePath:
+        """Builds the rule path for the entry of the path table with the
+        given index."""
+
+        table = self.get_path_table()
+        entries = []
+        while table_index >= 0:
+            entry = table[table_index]
+            entries.append(entry)
+            table_index = entry.parent
+        path = RulePath(self)
+        for entry in reversed(entries):
+            path.add(entry.rule, entry.index)
+        return path
+
     def get_scheduling_times(self) -> T.Set[datetime.time]:
         """Returns a set of times a re-scheduling should be triggered
         at. Rules of sub-schedules are considered as well."""
 
         times = set()  # type: T.Set[datetime.time]
-        for path in self.unfold():
-            for rule in path.rules:
-                if not rule.is_always_valid:
-                    times.update((rule.start_time, rule.end_time,))
+        for entry in self.get_path_table():
+            if not entry.rule.is_always_valid:
+                times.update((entry.rule.start_time, entry.rule.end_time,))
         return times
 
     def unfold(self) -> T.Iterator[RulePath]:
@@ -333,12 +831,88 @@ class Schedule:
         a leaf). A node is returned first, followed by it's successors
         (like in depth-first search)."""
 
-        for rule in self.rules:
-            path = RulePath(self)
-            path.add(rule)
-            yield path
-            if isinstance(rule, SubScheduleRule):
-                for path in rule.sub_schedule.unfold():
-                    path.root_schedule = self
-                    path.rules.insert(0, rule)
-                    yield path
+        for table_index in range(len(self.get_path_table())):
+            yield self.get_rule_path(table_index)
+
+
+class CompositeSchedule(Schedule):
+    """A schedule chaining the rules of other schedules, its segments,
+    without copying them. This is what adding schedules together
+    creates. Timelines are built by merging those of the segments, so
+    the date index of a segment shared by many composite schedules,
+    such as schedule_prepend, is computed only once. Its rules are
+    always those of its segments and can't be assigned."""
+
+    def __init__(
+            self, name: str = None, segments: T.Iterable[Schedule] = None,
+    ) -> None:
+        super().__init__(name=name)
+
+        _segments = []  # type: T.List[Schedule]
+        for segment in segments or ():
+            if isinstance(segment, CompositeSchedule):
+                _segments.extend(segment.segments)
+            else:
+                _segments.append(segment)
+        self.segments = tuple(_segments)  # type: T.Tuple[Schedule, ...]
+        self._rules_version = None  # type: T.Any
+        self._get_rules()
+
+    def _build_timeline(
+            self, rules: T.Iterable[Rule], date: datetime.date
+    ) -> DayTimeline:
+        """Merges the segments' timelines for the given date."""
+
+        # pylint: disable=protected-access
+        timelines = [segment._get_timeline(date) for segment in self.segments]
+        times = set()  # type: T.Set[datetime.time]
+        for timeline in timelines:
+            times.update(timeline.boundaries)
+        if not times:
+            times.add(datetime.time(0, 0))
+
+        boundaries = []  # type: T.List[datetime.time]
+        segments = []  # type: T.List[T.Tuple[Rule, ...]]
+        for _time in sorted(times):
+            segment = tuple(itertools.chain.from_iterable(
+                timeline.get_rules(_time) for timeline in timelines
+            ))
+            if segments and segment == segments[-1]:
+                continue
+            boundaries.append(_time)
+            segments.append(segment)
+
+        return DayTimeline(boundaries, segments)
+
+    @property
+    def rules(self) -> T.Tuple[Rule, ...]:
+        """The rules of all segments."""
+
+        return self._get_rules()
+
+    @rules.setter
+    def rules(self, rules: T.Tuple[Rule, ...]) -> None:
+        raise AttributeError(
+            "rules of {} can't be assigned, they are those of its segments"
+            .format(self)
+        )
+
+    def _get_rules(self) -> T.Tuple[Rule, ...]:
+        """Chains the rules of all segments, rebuilding the chain when
+        the rules of a segment have changed."""
+
+        version = self._get_version()
+        if version != self._rules_version:
+            self._rules = tuple(itertools.chain.from_iterable(
+                segment.rules for segment in self.segments
+            ))
+            self._rules_version = version
+        return self._rules
+
+    def _get_version(self) -> T.Any:
+        """Combines the versions of this schedule and its segments."""
+
+        # pylint: disable=protected-access
+        return (self._version,) + tuple(
+            segment._get_version() for segment in self.segments
+        )
@@ -0,0 +1,88 @@
+"""
+This module implements the StatePublisher class.
+"""
+
+import typing as T
+if T.TYPE_CHECKING:
+    # pylint: disable=cyclic-import,unused-import
+    import uuid
+    from .app import SchedyApp
+
+import threading
+
+
+StateType = T.Tuple[str, T.Dict[str, T.Any]]
+
+
+class StatePublisher:
+    """Collects the states of entities, such as those of rooms, and
+    writes them to Home Assistant in batches.
+    The first state published for an entity arms a timer of
+    state_publish_delay seconds. States published again before it
+    fires replace the pending one, and states that equal what has
+    been written last are dropped when flushing. Both count as saved
+    writes. A delay of 0 writes every state immediately."""
+
+    def __init__(self, app: "SchedyApp") -> None:
+        self.app = app
+        self.saved_writes = 0
+
+        self._lock = threading.Lock()
+        self._pending = {}  # type: T.Dict[str, StateType]
+        self._published = {}  # type: T.Dict[str, StateType]
+        self._timer = None  # type: T.Optional[uuid.UUID]
+
+    def __repr__(self) -> str:
+        return "<StatePublisher with {} pending states>" \
+               .format(len(self._pending))
+
+    def _flush_cb(self, kwargs: dict) -> None:
+        """Writes all pending states when the timer fires."""
+
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    def flush(self) -> None:
+        """Writes all pending states now and cancels the timer, if any."""
+
+        with self._lock:
+            if self._timer is not None:
+                self.app.cancel_timer(self._timer)
+                self._timer = None
+            pending, self._pending = self._pending, {}
+
+            writes = []
+            for entity_id, state_and_attrs in pending.items():
+                if state_and_attrs == self._published.get(entity_id):
+                    self.saved_writes += 1
+                    continue
+                self._published[entity_id] = state_and_attrs
+                writes.append((entity_id, state_and_attrs))
+            saved_writes = self.saved_writes
+
+        if not pending:
+            return
+
+        self.app.log("Writing {} of {} pending states, {} writes saved "
+                     "so far.", len(writes), len(pending), saved_writes,
+                     level="DEBUG")
+        for entity_id, (state, attrs) in writes:
+            self.app.set_state(entity_id, state=state, attributes=attrs)
+
+    def publish(
+            self, entity_id: str, state: str, attrs: T.Dict[str, T.Any]
+    ) -> None:
+        """Queues the given state and attributes to be written for
+        entity_id, replacing a state that is still pending for it."""
+
+        delay = self.app.cfg["state_publish_delay"]
+        with self._lock:
+            if entity_id in self._pending:
+                self.saved_writes += 1
+            self._pending[entity_id] = (state, attrs)
+            if delay and self._timer is None:
+                self._timer = self.app.run_in(self._flush_cb, delay)
+
+        if not delay:
+            self.flush()
@@ -0,0 +1,134 @@
+"""
+This module implements the TimerWheel class.
+"""
+
+import typing as T
+if T.TYPE_CHECKING:
+    # pylint: disable=cyclic-import,unused-import
+    import uuid
+    from .app import SchedyApp
+    from .room import Room
+
+import datetime
+import threading
+
+
+class TimerWheel:
+    """Shares scheduling timers between all rooms of an app.
+    Rooms register the moment at which they want to be notified and
+    only one AppDaemon timer, for the earliest of these moments, is
+    running. All rooms registered for the same moment are notified
+    from a single callback."""
+
+    # seconds after which a room that failed to handle its notification
+    # without registering again is notified once more
+    RETRY_DELAY = 60
+
+    def __init__(self, app: "SchedyApp") -> None:
+        self.app = app
+
+        self._lock = threading.Lock()
+        self._rooms_by_time = {}  # type: T.Dict[datetime.datetime, T.Set[Room]]
+        self._times_by_room = {}  # type: T.Dict[Room, datetime.datetime]
+        self._timer = None  # type: T.Optional[uuid.UUID]
+        self._timer_time = None  # type: T.Optional[datetime.datetime]
+
+    def __repr__(self) -> str:
+        return "<TimerWheel with {} trigger times>" \
+               .format(len(self._rooms_by_time))
+
+    def _arm_timer(self) -> None:
+        """Ensures the AppDaemon timer runs for the earliest trigger time.
+        self._lock has to be held when calling this."""
+
+        when = min(self._rooms_by_time) if self._rooms_by_time else None
+        if when == self._timer_time:
+            return
+
+        if self._timer is not None:
+            self.app.cancel_timer(self._timer)
+            self._timer, self._timer_time = None, None
+        if when is None:
+            return
+
+        if when <= self.app.datetime():
+            # run_at() refuses times that have already passed
+            self._timer = self.app.run_in(self._timer_cb, 0)
+        else:
+            self._timer = self.app.run_at(self._timer_cb, when)
+        self._timer_time = when
+
+    def _timer_cb(self, kwargs: dict) -> None:
+        """Notifies all rooms whose trigger time has come."""
+
+        with self._lock:
+            fired_time = self._timer_time
+            self._timer, self._timer_time = None, None
+
+            now = self.app.datetime()
+            if fired_time is not None and fired_time > now:
+                now = fired_time
+
+            due = set()  # type: T.Set[Room]
+            for when in [t for t in self._rooms_by_time if t <= now]:
+                for room in self._rooms_by_time.pop(when):
+                    del self._times_by_room[room]
+                    due.add(room)
+
+            self._arm_timer()
+
+        self.app.log("Scheduling timer fired for {} rooms.", len(due),
+                     level="DEBUG")
+        self.app.run_for_rooms(
+            [room for room in self.app.rooms if room in due],
+            lambda room: self._notify_room(room, now),
+        )
+
+    def _notify_room(self, room: "Room", now: datetime.datetime) -> None:
+        """Notifies a single room that its trigger time has come. Errors
+        are logged, and a room that didn't register again because of
+        one is retried after RETRY_DELAY seconds, so that it can't drop
+        out of the wheel."""
+
+        try:
+            room.notify_scheduling_time()
+        except Exception as err:  # pylint: disable=broad-except
+            self.app.log("Error while notifying {} of its scheduling "
+                         "time: {!r}", room, err,
+                         level="ERROR")
+            with self._lock:
+                if room not in self._times_by_room:
+                    when = now + datetime.timedelta(seconds=self.RETRY_DELAY)
+                    self._rooms_by_time.setdefault(when, set()).add(room)
+                    self._times_by_room[room] = when
+                    self._arm_timer()
+
+    def register(self, room: "Room", when: datetime.datetime) -> None:
+        """Registers the given room to be notified at when. A previous
+        registration of the same room is replaced."""
+
+        with self._lock:
+            self._unregister(room)
+            self._rooms_by_time.setdefault(when, set()).add(room)
+            self._times_by_room[room] = when
+            self._arm_timer()
+
+    def _unregister(self, room: "Room") -> None:
+        """Removes the registration of the given room, if any, without
+        re-arming the timer. self._lock has to be held when calling
+        this."""
+
+        when = self._times_by_room.pop(room, None)
+        if when is None:
+            return
+        rooms = self._rooms_by_time[when]
+        rooms.discard(room)
+        if not rooms:
+            del self._rooms_by_time[when]
+
+    def unregister(self, room: "Room") -> None:
+        """Removes the registration of the given room, if any."""
+
+        with self._lock:
+            self._unregister(room)
+            self._arm_timer()
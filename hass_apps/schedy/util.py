@@ -5,11 +5,47 @@ Utility functions that are used all around Schedy.
 import types
 import typing as T
 
+import ast
 import collections
 import datetime
+import dis
+import functools
+import inspect
 import re
-
-
+import sys
+import weakref
+
+
+# AST node types allowed in constant expressions, in addition to names
+CONSTANT_EXPRESSION_NODES = (
+    ast.Expression, ast.Call, ast.keyword, ast.Attribute, ast.UnaryOp,
+    ast.BinOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Tuple, ast.List,
+    ast.Dict, ast.Set, ast.expr_context, ast.operator, ast.unaryop,
+    ast.boolop, ast.cmpop,
+)  # type: T.Tuple[T.Type[ast.AST], ...]
+if sys.version_info >= (3, 8):
+    CONSTANT_EXPRESSION_NODES += (ast.Constant,)
+else:
+    CONSTANT_EXPRESSION_NODES += (ast.Num, ast.Str, ast.Bytes, ast.NameConstant)
+# names of builtins allowed in constant expressions
+CONSTANT_EXPRESSION_BUILTINS = frozenset((
+    "abs", "bool", "float", "int", "max", "min", "round", "str",
+))
+# file names compile_expression() marks code compiled in eval and exec
+# mode with
+EXPRESSION_FILENAME = "expr"
+SCRIPT_FILENAME = "script"
+# arguments of the functions compile_expression() wraps expressions into
+EXPRESSION_FUNCTION_ARGS = ("now", "date", "time", "room_name")
+# number of compiled expressions to keep in compile_expression()'s cache
+COMPILE_CACHE_SIZE = 1024
+# names of the expression helpers taking an entity id as first argument
+ENTITY_ACCESS_FUNCTIONS = ("is_off", "is_on", "state")
+# maps the ids of code objects of simple expressions to a weak reference
+# to the code object and the code of the function it has been wrapped
+# into by compile_expression(); code objects compare by value, hence
+# they can't be used as keys themselves
+_FUNCTION_CODES = {}  # type: T.Dict[int, T.Tuple[weakref.ref, types.CodeType]]
 # matches any character that is not allowed in Python variable names
 INVALID_VAR_NAME_CHAR_PATTERN = re.compile(r"[^0-9A-Za-z_]")
 # regexp pattern matching a range like 3-7 without spaces
@@ -49,6 +85,16 @@ class RangingSet(set):
         ))
 
 
+def build_bitmask(numbers: T.Iterable[int]) -> int:
+    """Builds an integer with the bits at the given positions set.
+    Negative numbers are ignored."""
+
+    mask = 0
+    for number in numbers:
+        if number >= 0:
+            mask |= 1 << number
+    return mask
+
 def build_date_from_constraint(
         constraint: T.Dict[str, int], default_date: datetime.date,
         direction: int = 0
@@ -90,15 +136,191 @@ def build_date_from_constraint(
                 fields["year"] += 1
 
 def compile_expression(expr: str) -> types.CodeType:
-    """Compiles strings to code objects.
+    """Compiles strings to code objects, which can be run with
+    exec_expression().
     Strings with one or more newlines are assumed to contain whole
     statements already.
     Strings without newlines are treated as simple expressions and
-    "result = " is prepended to them before compilation."""
+    compiled in eval mode. If that fails, e.g. because they contain an
+    assignment, "result = " is prepended to them before compilation.
+    For simple expressions, a function is compiled as well, see
+    get_function_code().
+    Code objects are cached by their normalized source."""
+
+    if "\n" in expr:
+        expr = "{}\n".format(expr.rstrip())
+    else:
+        expr = expr.strip()
+    return _compile_expression_cached(expr)
+
+@functools.lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _compile_expression_cached(expr: str) -> types.CodeType:
+    """Compiles normalized expressions, caching the code objects so that
+    expressions seen before, e.g. in schedy_set_value events, needn't
+    be compiled again."""
 
     if "\n" not in expr:
-        expr = "result = {}".format(expr)
-    return compile(expr, "expr", "exec")
+        try:
+            code = compile(expr, EXPRESSION_FILENAME, "eval")
+        except SyntaxError:
+            expr = "result = {}".format(expr)
+        else:
+            func_code = _compile_expression_function(expr)
+            if func_code is not None:
+                _register_function_code(code, func_code)
+            return code
+    return compile(expr, SCRIPT_FILENAME, "exec")
+
+def _compile_expression_function(expr: str) -> T.Optional[types.CodeType]:
+    """Compiles a function returning the result of the given simple
+    expression and returns its code. The function's arguments are
+    listed in EXPRESSION_FUNCTION_ARGS. None is returned if the
+    expression can't be wrapped into a normal function, e.g. because
+    it would turn into a generator."""
+
+    source = "def expression({}):\n    return ({}\n)\n".format(
+        ", ".join(EXPRESSION_FUNCTION_ARGS), expr
+    )
+    try:
+        module_code = compile(source, EXPRESSION_FILENAME, "exec")
+    except SyntaxError:
+        return None
+    for const in module_code.co_consts:
+        if isinstance(const, types.CodeType):
+            if const.co_flags & (inspect.CO_GENERATOR | inspect.CO_COROUTINE):
+                return None
+            return const
+    return None
+
+def get_function_code(code: types.CodeType) -> T.Optional[types.CodeType]:
+    """Returns the code of the function compile_expression() wrapped the
+    simple expression compiled to code into, or None if there is none.
+    It can be bound to globals with types.FunctionType and has to be
+    called with the arguments listed in EXPRESSION_FUNCTION_ARGS."""
+
+    entry = _FUNCTION_CODES.get(id(code))
+    if entry is None or entry[0]() is not code:
+        return None
+    return entry[1]
+
+def _register_function_code(
+        code: types.CodeType, func_code: types.CodeType
+) -> None:
+    """Makes get_function_code() return func_code for code. The entry
+    is removed again when code is garbage-collected."""
+
+    key = id(code)
+
+    def remove(ref: weakref.ref) -> None:
+        """Drops the entry unless it has been replaced for a new code
+        object with the same id already."""
+
+        entry = _FUNCTION_CODES.get(key)
+        if entry is not None and entry[0] is ref:
+            del _FUNCTION_CODES[key]
+
+    _FUNCTION_CODES[key] = (weakref.ref(code, remove), func_code)
+
+def compile_cache_info() -> T.Any:
+    """Returns the statistics of compile_expression()'s cache as a named
+    tuple with hits, misses, maxsize and currsize."""
+
+    return _compile_expression_cached.cache_info()
+
+def exec_expression(
+        code: types.CodeType, env: T.Dict[str, T.Any],
+        local_env: T.Optional[T.Dict[str, T.Any]] = None,
+) -> T.Any:
+    """Runs code returned by compile_expression() with env as globals
+    and returns its result. Simple expressions are evaluated directly,
+    statements have to store their result in the result variable.
+    If local_env is given, it's used as locals, which only works as
+    expected for code is_flat_code() returns True for."""
+
+    if local_env is None:
+        local_env = env
+    if code.co_filename == EXPRESSION_FILENAME:
+        return eval(code, env, local_env)  # pylint: disable=eval-used
+    exec(code, env, local_env)  # pylint: disable=exec-used
+    return local_env.get("result")
+
+@functools.lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def is_flat_code(code: types.CodeType) -> bool:
+    """Tells whether the given code has no nested scopes, such as
+    functions, lambdas or comprehensions, and doesn't assign to global
+    names. Only then names in the locals passed to exec_expression()
+    are visible everywhere in the code and assignments stay there."""
+
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            return False
+    for instr in dis.get_instructions(code):
+        if instr.opname in ("STORE_GLOBAL", "DELETE_GLOBAL"):
+            return False
+    return True
+
+def extract_entity_ids(expr: str) -> T.FrozenSet[str]:
+    """Returns the ids of all entities the given expression passes as
+    literal strings to state(), is_on() or is_off(). Entity ids that are
+    computed at runtime can't be found this way."""
+
+    try:
+        tree = ast.parse(expr, mode="exec")
+    except SyntaxError:
+        return frozenset()
+
+    entity_ids = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not node.args or \
+           not isinstance(node.func, ast.Name) or \
+           node.func.id not in ENTITY_ACCESS_FUNCTIONS:
+            continue
+        arg = node.args[0]
+        if sys.version_info >= (3, 8):
+            value = arg.value if isinstance(arg, ast.Constant) else None
+        else:
+            value = arg.s if isinstance(arg, ast.Str) else None
+        if isinstance(value, str) and "." in value:
+            entity_ids.add(value)
+    return frozenset(entity_ids)
+
+def get_code_names(code: types.CodeType) -> T.Set[str]:
+    """Returns the names of all globals, attributes and variables used
+    by the given code object, including those of nested functions and
+    comprehensions."""
+
+    names = set(code.co_names)
+    names.update(code.co_varnames)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(get_code_names(const))
+    return names
+
+def is_constant_expression(expr: str, names: T.Container[str]) -> bool:
+    """Tells whether the given string is a single-line expression whose
+    result is always the same, hence it may be evaluated once and
+    then be cached. Such expressions may consist of literals, operators,
+    calls and non-private attributes of the given names, which thus must
+    be free of side effects, and of some builtins like min() and max()."""
+
+    if "\n" in expr:
+        return False
+    try:
+        tree = ast.parse(expr, mode="eval")
+    except SyntaxError:
+        return False
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id not in names and \
+               node.id not in CONSTANT_EXPRESSION_BUILTINS:
+                return False
+        elif isinstance(node, ast.Attribute):
+            if node.attr.startswith("_"):
+                return False
+        elif not isinstance(node, CONSTANT_EXPRESSION_NODES):
+            return False
+    return True
 
 def deep_merge_dicts(source: dict, dest: dict) -> None:
     """Inserts missing items from source into dest, descending into
@@ -160,6 +382,24 @@ def format_time(when: datetime.time, format_str: str = TIME_FORMAT) -> str:
 
     return when.strftime(format_str)
 
+def freeze_value(value: T.Any) -> T.Hashable:
+    """Converts the given value into a hashable representation that
+    compares equal only for values of the same types and contents.
+    Dicts, lists, tuples and sets are converted recursively.
+    A TypeError is raised for values that can't be represented."""
+
+    if isinstance(value, dict):
+        return (type(value), frozenset(
+            (freeze_value(key), freeze_value(item))
+            for key, item in value.items()
+        ))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(freeze_value(item) for item in value))
+    if isinstance(value, (set, frozenset)):
+        return (type(value), frozenset(freeze_value(item) for item in value))
+    hash(value)
+    return (type(value), value)
+
 def mixin_dict(dest: dict, mixin: dict) -> dict:
     """Updates the first dict with the items from the second and returns it."""
 